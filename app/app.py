@@ -6,12 +6,13 @@ import logging
 import gradio as gr
 from gcp_storage import initialize_gcp_credentials
 from models import SessionLocal, Job, init_db
-from job_manager import start_worker
-from sqlalchemy import desc
+from job_manager import start_worker, notify_new_job
+from services import place_file
+from sqlalchemy import desc, select
 import datetime
-import shutil
 import uuid
 import json
+import random
 
 # -------------------- 
 # Configure Logging
@@ -121,7 +122,7 @@ def poll_job_status(job_id, progress=None):
                 session.close()
             session = SessionLocal()
             
-            job = session.query(Job).filter(Job.id == job_id).first()
+            job = session.get(Job, job_id)
             
             if not job:
                 logger.error(f"Job {job_id} not found in database")
@@ -169,7 +170,12 @@ def get_recent_jobs():
     
     session = SessionLocal()
     try:
-        jobs = session.query(Job).order_by(desc(Job.created_at)).limit(10).all()
+        # Load only the columns the table shows; rows keep attribute access
+        jobs = session.execute(
+            select(Job.id, Job.status, Job.created_at, Job.updated_at, Job.parameters, Job.gcp_urls_json)
+            .order_by(desc(Job.created_at))
+            .limit(10)
+        ).all()
         
         if not jobs:
             return "No recent jobs"
@@ -417,7 +423,7 @@ def get_current_job_status():
     
     session = SessionLocal()
     try:
-        job = session.query(Job).filter(Job.id == current_job_id).first()
+        job = session.get(Job, current_job_id)
         
         if not job:
             return f"Job {current_job_id} not found"
@@ -461,7 +467,6 @@ def process_audio(file, start_time, bpm, seed, randomize_seed, model_set, voice_
         
         # Handle randomized seed if checkbox is checked
         if randomize_seed:
-            import random
             seed = random.randint(0, 10000)
             logger.info(f"Randomized seed to: {seed}")
         
@@ -469,7 +474,14 @@ def process_audio(file, start_time, bpm, seed, randomize_seed, model_set, voice_
         session = SessionLocal()
         job = Job(
             status="pending",
-            parameters=f"start_time={start_time},bpm={bpm},seed={seed},model_set={model_set},sex={voice_type}"
+            parameters=f"start_time={start_time},bpm={bpm},seed={seed},model_set={model_set},sex={voice_type}",
+            parameters_json={
+                "start_time": start_time,
+                "bpm": bpm,
+                "seed": seed,
+                "model_set": model_set,
+                "sex": voice_type
+            }
         )
         session.add(job)
         session.commit()
@@ -498,8 +510,8 @@ def process_audio(file, start_time, bpm, seed, randomize_seed, model_set, voice_
         
         # Handle both string paths and file objects
         if isinstance(file, str):
-            # If file is already a path, just copy it
-            shutil.copy2(file, file_path)
+            # If file is already a path, link or copy it
+            place_file(file, file_path, keep_source=True)
         else:
             # Otherwise read and write the file
             with open(file_path, "wb") as f:
@@ -519,8 +531,9 @@ def process_audio(file, start_time, bpm, seed, randomize_seed, model_set, voice_
         
         # Update the job with the input file path
         session = SessionLocal()
-        job = session.query(Job).filter(Job.id == job_id).first()
+        job = session.get(Job, job_id)
         job.input_file = file_path
+        notify_new_job(session)
         session.commit()
         session.close()
         
@@ -594,37 +607,42 @@ def process_audio(file, start_time, bpm, seed, randomize_seed, model_set, voice_
                     logger.info(f"Found beat mix file at: {beat_mix_file_path}")
                     break
             
-            # Copy files to job-specific directories if they exist
+            # Copy files to job-specific directories if they exist. Files in the
+            # job's own directories are hard-linked; the shared melody directory
+            # is rewritten by later runs, so files from there are copied
             files_copied = []
+            shared_melody_dir = os.path.join(SHARED_DIR, f"melody_results{model_suffix}")
             
             if os.path.exists(vocal_melody_path):
                 os.makedirs(os.path.dirname(vocal_path), exist_ok=True)
-                shutil.copy2(vocal_melody_path, vocal_path)
-                logger.info(f"Copied vocal file to {vocal_path}")
+                action = place_file(vocal_melody_path, vocal_path, keep_source=True)
+                logger.info(f"{action} vocal file to {vocal_path}")
                 files_copied.append("vocal")
             else:
                 logger.warning(f"Vocal file not found at {vocal_melody_path}")
             
             if os.path.exists(mixed_track_path):
                 os.makedirs(os.path.dirname(mixed_path), exist_ok=True)
-                shutil.copy2(mixed_track_path, mixed_path)
-                logger.info(f"Copied mixed file to {mixed_path}")
+                action = place_file(mixed_track_path, mixed_path, keep_source=True)
+                logger.info(f"{action} mixed file to {mixed_path}")
                 files_copied.append("mixed")
             else:
                 logger.warning(f"Mixed file not found at {mixed_track_path}")
             
             if midi_file_path and os.path.exists(midi_file_path):
                 os.makedirs(os.path.dirname(midi_path), exist_ok=True)
-                shutil.copy2(midi_file_path, midi_path)
-                logger.info(f"Copied MIDI file to {midi_path}")
+                action = place_file(midi_file_path, midi_path, keep_source=True,
+                                    copy=os.path.dirname(midi_file_path) == shared_melody_dir)
+                logger.info(f"{action} MIDI file to {midi_path}")
                 files_copied.append("midi")
             else:
                 logger.warning("MIDI file not found in any of the expected locations")
             
             if beat_mix_file_path and os.path.exists(beat_mix_file_path):
                 os.makedirs(os.path.dirname(beat_mix_path), exist_ok=True)
-                shutil.copy2(beat_mix_file_path, beat_mix_path)
-                logger.info(f"Copied beat mix file to {beat_mix_path}")
+                action = place_file(beat_mix_file_path, beat_mix_path, keep_source=True,
+                                    copy=os.path.dirname(beat_mix_file_path) == shared_melody_dir)
+                logger.info(f"{action} beat mix file to {beat_mix_path}")
                 files_copied.append("beat_mix")
             else:
                 logger.warning("Beat mix file not found in any of the expected locations")
@@ -639,7 +657,7 @@ def process_audio(file, start_time, bpm, seed, randomize_seed, model_set, voice_
             
             # Update the job record with the new output file path
             session = SessionLocal()
-            job = session.query(Job).filter(Job.id == job_id).first()
+            job = session.get(Job, job_id)
             job.output_file = mixed_path if os.path.exists(mixed_path) else output_file
             session.commit()
             session.close()
@@ -684,7 +702,6 @@ def process_audio(file, start_time, bpm, seed, randomize_seed, model_set, voice_
 
 # Function to randomize the seed value
 def randomize_seed_value():
-    import random
     new_seed = random.randint(0, 10000)
     return gr.update(value=new_seed)
 
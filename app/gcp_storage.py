@@ -7,6 +7,7 @@ import logging
 from google.cloud import storage
 import glob
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -17,6 +18,10 @@ SERVICE_ACCOUNT_FILE = "access.json"
 # GCP bucket name
 BUCKET_NAME = "melody_generation_api_bucket"
 
+# GCS has no batch media upload, so files of a job are uploaded in parallel
+UPLOAD_CONCURRENCY = int(os.environ.get("GCP_UPLOAD_CONCURRENCY", "16"))
+_upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY, thread_name_prefix="gcp-upload")
+
 def initialize_gcp_credentials():
     """
     Initialize GCP credentials and validate access to the bucket.
@@ -81,9 +86,6 @@ def upload_file(local_file_path, gcp_path):
         # Upload the file
         blob.upload_from_filename(local_file_path)
         
-        # Generate a signed URL with expiration time
-        import datetime
-        
         # Generate a signed URL that expires in 7 days
         signed_url = blob.generate_signed_url(
             version="v4",
@@ -99,7 +101,61 @@ def upload_file(local_file_path, gcp_path):
         logger.error(f"Error uploading {local_file_path}: {str(e)}")
         return None
 
-def upload_job_files(job_id, shared_dir):
+def upload_files(uploads):
+    """
+    Upload several files to GCP Storage concurrently.
+    
+    Args:
+        uploads: List of (local_file_path, gcp_path) tuples
+        
+    Returns:
+        List of signed URLs (None for failed uploads) in the order of uploads
+    """
+    if not uploads:
+        return []
+    return list(_upload_executor.map(lambda upload: upload_file(*upload), uploads))
+
+def _scan_job_dirs(shared_dir, job_id, model_set="set1"):
+    """
+    Scan every directory that can hold files for a job in a single pass.
+    
+    Args:
+        shared_dir: Base shared directory containing job files
+        job_id: The job ID
+        model_set: Model set whose result directories should be scanned
+        
+    Returns:
+        Dictionary mapping paths relative to shared_dir to absolute file paths
+    """
+    model_suffix = f"_{model_set}" if model_set != "" else ""
+    job_folder = f"job_{job_id}"
+    
+    # Job-specific directories, the base result directories (top-level files
+    # only) and the un-suffixed fallback directories
+    candidate_dirs = [
+        os.path.join("input", job_folder),
+        os.path.join(f"melody_results{model_suffix}", job_folder),
+        f"melody_results{model_suffix}",
+        os.path.join(f"vocal_results{model_suffix}", job_folder),
+        f"vocal_results{model_suffix}",
+    ]
+    if model_suffix:
+        candidate_dirs.append(os.path.join("melody_results", job_folder))
+        candidate_dirs.append(os.path.join("vocal_results", job_folder))
+    
+    file_map = {}
+    for rel_dir in candidate_dirs:
+        try:
+            with os.scandir(os.path.join(shared_dir, rel_dir)) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        file_map[os.path.join(rel_dir, entry.name)] = entry.path
+        except FileNotFoundError:
+            continue
+    
+    return file_map
+
+def upload_job_files(job_id, shared_dir, file_map=None):
     """
     Upload all files for a specific job to GCP with timestamp in folder name.
     Handles model-specific directories (set1, set2).
@@ -107,6 +163,8 @@ def upload_job_files(job_id, shared_dir):
     Args:
         job_id: The job ID
         shared_dir: Base shared directory containing job files
+        file_map: Optional result of _scan_job_dirs; the directories are
+            scanned here when it is not provided
         
     Returns:
         Dictionary with file types and their public URLs
@@ -123,9 +181,9 @@ def upload_job_files(job_id, shared_dir):
         try:
             from models import SessionLocal, Job
             session = SessionLocal()
-            job = session.query(Job).filter(Job.id == job_id).first()
-            if job and job.parameters:
-                params = dict(param.split('=') for param in job.parameters.split(','))
+            job = session.get(Job, job_id)
+            if job:
+                params = job.get_parameters()
                 if 'model_set' in params:
                     model_set = params.get('model_set', 'set1')
                     logger.info(f"Found model_set={model_set} in job parameters")
@@ -135,97 +193,53 @@ def upload_job_files(job_id, shared_dir):
         
         # Define model suffix based on model_set
         model_suffix = f"_{model_set}" if model_set != "" else ""
+        job_folder = f"job_{job_id}"
         
-        # Define job-specific directories
-        job_input_dir = os.path.join(shared_dir, "input", f"job_{job_id}")
-        
-        # Use model-specific directories for melody and vocal results
-        job_melody_dir = os.path.join(shared_dir, f"melody_results{model_suffix}", f"job_{job_id}")
-        job_vocal_dir = os.path.join(shared_dir, f"vocal_results{model_suffix}", f"job_{job_id}")
+        if file_map is None:
+            file_map = _scan_job_dirs(shared_dir, job_id, model_set)
         
-        logger.info(f"Uploading files for job {job_id} with model_set={model_set}")
-        logger.info(f"Looking in directories: {job_input_dir}, {job_melody_dir}, {job_vocal_dir}")
+        logger.info(f"Uploading {len(file_map)} candidate files for job {job_id} with model_set={model_set}")
         
-        # Upload input files
-        input_files = glob.glob(os.path.join(job_input_dir, "*"))
-        for input_file in input_files:
-            filename = os.path.basename(input_file)
-            gcp_path = f"{timestamp_folder}/input/{filename}"
-            url = upload_file(input_file, gcp_path)
-            if url:
-                urls[f"input_{filename}"] = url
+        # Map each scanned directory to its GCP path prefix and URL key prefix
+        primary_dirs = {
+            os.path.join("input", job_folder): ("input/", "input_"),
+            os.path.join(f"melody_results{model_suffix}", job_folder): ("melody/", "melody_"),
+            f"melody_results{model_suffix}": ("melody/base_", "melody_base_"),
+            os.path.join(f"vocal_results{model_suffix}", job_folder): ("vocal/", "vocal_"),
+            f"vocal_results{model_suffix}": ("vocal/base_", "vocal_base_"),
+        }
+        fallback_dirs = {}
+        if model_suffix:
+            fallback_dirs = {
+                os.path.join("melody_results", job_folder): ("melody/", "melody_"),
+                os.path.join("vocal_results", job_folder): ("vocal/", "vocal_"),
+            }
         
-        # Upload melody files - including all files in the directory
-        melody_files = glob.glob(os.path.join(job_melody_dir, "*"))
-        for melody_file in melody_files:
-            filename = os.path.basename(melody_file)
-            gcp_path = f"{timestamp_folder}/melody/{filename}"
-            url = upload_file(melody_file, gcp_path)
-            if url:
-                urls[f"melody_{filename}"] = url
-                
-        # Also check for melody files that might be in the base melody_results directory
-        base_melody_dir = os.path.join(shared_dir, f"melody_results{model_suffix}")
-        base_melody_files = glob.glob(os.path.join(base_melody_dir, "*"))
-        for melody_file in base_melody_files:
-            # Only upload files, not directories
-            if os.path.isfile(melody_file):
-                filename = os.path.basename(melody_file)
-                gcp_path = f"{timestamp_folder}/melody/base_{filename}"
-                url = upload_file(melody_file, gcp_path)
+        def upload_from(dir_map):
+            uploads = []
+            keys = []
+            for rel_path, abs_path in file_map.items():
+                rel_dir, filename = os.path.split(rel_path)
+                if rel_dir not in dir_map:
+                    continue
+                gcp_prefix, key_prefix = dir_map[rel_dir]
+                uploads.append((abs_path, f"{timestamp_folder}/{gcp_prefix}{filename}"))
+                keys.append(f"{key_prefix}{filename}")
+            
+            for key, url in zip(keys, upload_files(uploads)):
                 if url:
-                    urls[f"melody_base_{filename}"] = url
+                    urls[key] = url
         
-        # Upload vocal files - including all files in the directory
-        vocal_files = glob.glob(os.path.join(job_vocal_dir, "*"))
-        for vocal_file in vocal_files:
-            filename = os.path.basename(vocal_file)
-            gcp_path = f"{timestamp_folder}/vocal/{filename}"
-            url = upload_file(vocal_file, gcp_path)
-            if url:
-                urls[f"vocal_{filename}"] = url
-                
-        # Also check for vocal files that might be in the base vocal_results directory
-        base_vocal_dir = os.path.join(shared_dir, f"vocal_results{model_suffix}")
-        base_vocal_files = glob.glob(os.path.join(base_vocal_dir, "*"))
-        for vocal_file in base_vocal_files:
-            # Only upload files, not directories
-            if os.path.isfile(vocal_file):
-                filename = os.path.basename(vocal_file)
-                gcp_path = f"{timestamp_folder}/vocal/base_{filename}"
-                url = upload_file(vocal_file, gcp_path)
-                if url:
-                    urls[f"vocal_base_{filename}"] = url
+        upload_from(primary_dirs)
         
         # Check if we found any files
         if not urls:
             logger.warning(f"No files found for job {job_id} with model_set={model_set}")
             
             # If no files were found with the model suffix, try without it (fallback)
-            if model_suffix:
+            if fallback_dirs:
                 logger.info(f"Trying fallback to directories without model suffix")
-                
-                # Try standard directories as fallback
-                job_melody_dir_fallback = os.path.join(shared_dir, "melody_results", f"job_{job_id}")
-                job_vocal_dir_fallback = os.path.join(shared_dir, "vocal_results", f"job_{job_id}")
-                
-                # Upload melody files from fallback directory
-                melody_files = glob.glob(os.path.join(job_melody_dir_fallback, "*"))
-                for melody_file in melody_files:
-                    filename = os.path.basename(melody_file)
-                    gcp_path = f"{timestamp_folder}/melody/{filename}"
-                    url = upload_file(melody_file, gcp_path)
-                    if url:
-                        urls[f"melody_{filename}"] = url
-                
-                # Upload vocal files from fallback directory
-                vocal_files = glob.glob(os.path.join(job_vocal_dir_fallback, "*"))
-                for vocal_file in vocal_files:
-                    filename = os.path.basename(vocal_file)
-                    gcp_path = f"{timestamp_folder}/vocal/{filename}"
-                    url = upload_file(vocal_file, gcp_path)
-                    if url:
-                        urls[f"vocal_{filename}"] = url
+                upload_from(fallback_dirs)
         
         logger.info(f"Uploaded {len(urls)} files for job {job_id} with timestamp {timestamp}")
         return urls
@@ -260,9 +274,9 @@ def upload_job_results(job_id, input_file=None, melody_file=None, vocal_file=Non
         try:
             from models import SessionLocal, Job
             session = SessionLocal()
-            job = session.query(Job).filter(Job.id == job_id).first()
-            if job and job.parameters:
-                params = dict(param.split('=') for param in job.parameters.split(','))
+            job = session.get(Job, job_id)
+            if job:
+                params = job.get_parameters()
                 if 'model_set' in params:
                     model_set = params.get('model_set', 'set1')
                     logger.info(f"Found model_set={model_set} in job parameters")
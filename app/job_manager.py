@@ -1,197 +1,485 @@
 import threading
 import time
-import datetime
 import logging
 import os
-from models import SessionLocal, Job
-from services import process_song, check_container_running
+import select
+import queue
+import atexit
+from functools import lru_cache
+from models import SessionLocal, Job, engine
+from sqlalchemy import text
+from services import process_song, check_containers_running
 from gcp_storage import upload_job_results
-from gcp_storage import upload_job_files
-import json
+from gcp_storage import upload_job_files, _scan_job_dirs
+import orjson
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
-def process_job(job_id, checkpoint, gen_seed, shared_dir):
+# PostgreSQL channel used to announce new jobs to the worker
+NEW_JOB_CHANNEL = "new_job"
+# Seconds the worker waits for a notification before re-scanning anyway
+LISTEN_TIMEOUT = 30
+# Seconds before LISTEN is tried again after it failed, doubling per failure
+LISTEN_RETRY_DELAY = 5
+LISTEN_RETRY_MAX_DELAY = 300
+
+# Atomically move up to :n runnable jobs to "processing" and return their ids
+CLAIM_PENDING_JOBS = text("""
+    UPDATE jobs SET status = 'processing', updated_at = now()
+    WHERE id IN (
+        SELECT id FROM jobs
+        WHERE status = 'pending' AND input_file IS NOT NULL
+        ORDER BY created_at
+        FOR UPDATE SKIP LOCKED
+        LIMIT :n
+    )
+    RETURNING id
+""")
+
+# Job state changes waiting to be written by the single db-writer thread;
+# items are (job_id, fields) tuples, or None to stop the writer
+state_q = queue.Queue()
+STATE_BATCH_SIZE = 100
+STATE_FLUSH_INTERVAL = 0.05  # seconds
+# Backoff for job changes whose write failed: the first retry waits
+# STATE_RETRY_DELAY, doubling up to STATE_RETRY_MAX_DELAY, and a change is
+# dropped after STATE_MAX_ATTEMPTS failed writes
+STATE_RETRY_DELAY = 0.5  # seconds
+STATE_RETRY_MAX_DELAY = 60  # seconds
+STATE_MAX_ATTEMPTS = 10
+# Columns the db-writer may update and the SQL expression each is set to
+STATE_COLUMNS = {
+    "status": ":status",
+    "output_file": ":output_file",
+    "gcp_url": ":gcp_url",
+    "gcp_urls_json": ":gcp_urls_json",
+    "parameters_json": "CAST(:parameters_json AS JSONB)",
+}
+
+# Runs upload_job_files in the background so job threads do not wait on GCP;
+# its workers bound how many jobs upload at once
+UPLOAD_WORKERS = int(os.getenv("JOB_UPLOAD_WORKERS", "8"))
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+# Uploads that may be running or queued at once; a job thread waits for a
+# free slot before handing off, so finished jobs cannot pile up unbounded
+# (each queued upload holds its file map in memory)
+UPLOAD_BACKLOG = UPLOAD_WORKERS * 2
+_upload_slots = threading.BoundedSemaphore(UPLOAD_BACKLOG)
+
+# Containers checked by the worker at startup
+SET1_CONTAINERS = ("melody-generation-set1", "vocal-mix-set1")
+SET2_CONTAINERS = ("melody-generation-set2", "vocal-mix-set2")
+
+@dataclass(frozen=True, slots=True)
+class WorkerConfig:
+    """Settings shared by every job processed by the background worker."""
+    checkpoint: str
+    gen_seed: int
+    shared_dir: str
+
+def process_job(job_id, cfg):
     """
-    Process a single job by ID.
+    Process a single job by ID using the worker configuration in cfg.
     """
     session = SessionLocal()
-    job = session.query(Job).filter(Job.id == job_id).first()
+    job = session.get(Job, job_id)
     
     if not job:
-        logger.error(f"Job {job_id} not found in database")
+        logger.error("Job %s not found in database", job_id)
+        SessionLocal.remove()
         return
         
     try:
-        logger.info(f"Starting to process job {job_id}")
-        job.status = "processing"
-        job.updated_at = datetime.datetime.utcnow()
-        session.commit()
+        # The job was already moved to "processing" when it was claimed
+        logger.info("Starting to process job %s", job_id)
         
         # Log job details
-        logger.info(f"Processing job {job.id} with input file {job.input_file}")
-        logger.info(f"Job parameters: {job.parameters}")
+        logger.info("Processing job %s with input file %s", job.id, job.input_file)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Job parameters: %s", job.parameters)
         
         # Parse job parameters
         start_time = 0
         bpm = 0
-        job_seed = gen_seed  # Default to global seed
+        job_seed = cfg.gen_seed  # Default to global seed
         model_set = "set1"   # Default to set1
         sex = "female"       # Default to female voice
         
-        if job.parameters:
-            params = dict(param.split('=') for param in job.parameters.split(','))
+        params = job.get_parameters()
+        if params:
             start_time = float(params.get('start_time', 0))
             bpm = int(float(params.get('bpm', 0)))
             
             # Extract the job-specific seed if available
             if 'seed' in params:
-                job_seed = int(float(params.get('seed', gen_seed)))
-                logger.info(f"Using job-specific seed: {job_seed}")
+                job_seed = int(float(params.get('seed', cfg.gen_seed)))
+                logger.info("Using job-specific seed: %s", job_seed)
                 
             # Extract model_set if available
             if 'model_set' in params:
                 model_set = params.get('model_set', 'set1')
-                logger.info(f"Using model set: {model_set}")
+                logger.info("Using model set: %s", model_set)
                 
             # Extract sex parameter if available
             if 'sex' in params:
                 sex = params.get('sex', 'female')
-                logger.info(f"Using voice type: {sex}")
+                logger.info("Using voice type: %s", sex)
         
         # Store the model_set in the database
         # Update the parameters to include model_set if it's not already there
-        if job.parameters and 'model_set=' not in job.parameters:
-            job.parameters += f",model_set={model_set}"
-        elif not job.parameters:
-            job.parameters = f"model_set={model_set}"
-        session.commit()
-        
-        # Check if the input file exists
-        if not os.path.exists(job.input_file):
-            error_msg = f"Input file {job.input_file} does not exist"
-            logger.error(error_msg)
-            job.status = "failed"
-            session.commit()
+        if "model_set" not in params:
+            params["model_set"] = model_set
+            update_job_state(job_id, parameters_json=orjson.dumps(params).decode())
+        
+        # Fail early if a model set 1 container has died since startup
+        if model_set == "set1":
+            stopped = [name for name, running in check_containers_running(*SET1_CONTAINERS).items() if not running]
+            if stopped:
+                logger.error("Job %s failed: containers not running: %s", job_id, stopped)
+                update_job_state(job_id, status="failed")
+                return
+        
+        # Check if the input file exists; the stat result is handed to
+        # process_song so it does not have to look at the file again
+        try:
+            input_stat = os.stat(job.input_file)
+        except FileNotFoundError:
+            logger.error("Input file %s does not exist", job.input_file)
+            update_job_state(job_id, status="failed")
             return
             
         # Run the complete song processing (melody generation and vocal mix)
-        logger.info(f"Calling process_song with input file: {job.input_file} and model_set: {model_set}")
+        logger.info("Calling process_song with input file: %s and model_set: %s", job.input_file, model_set)
         final_mix, beat_mix_file = process_song(
-            shared_dir=shared_dir, 
+            shared_dir=cfg.shared_dir, 
             input_bgm=job.input_file, 
-            checkpoint=checkpoint, 
+            checkpoint=cfg.checkpoint, 
             gen_seed=job_seed, 
             job_id=job_id, 
             start_time=start_time, 
             bpm=bpm,
             model_set=model_set,
-            sex=sex
+            sex=sex,
+            input_size=input_stat.st_size
         )
         
-        logger.info(f"Processing complete. Output file: {final_mix}")
-        job.output_file = final_mix
+        # Scan the job directories once; the result decides the output file
+        # and is reused for the GCP upload below
+        file_map = _scan_job_dirs(cfg.shared_dir, job_id, model_set)
+        if not final_mix:
+            final_mix = file_map.get(os.path.join(f"vocal_results_{model_set}", f"job_{job_id}", "mix.wav"))
+        
+        logger.info("Processing complete. Output file: %s", final_mix)
+        
+        # A job without its final mix has failed; do not upload it
+        if not final_mix:
+            logger.error("Job %s failed: no final mix was produced", job_id)
+            update_job_state(job_id, status="failed")
+            return
         
-        # Try to upload files to GCP using the enhanced method
+        # Upload ALL files from job-specific directories using the upload_job_files function
+        # This will include timestamps in folder names and scan all files in the directories
+        # The job is marked completed from the upload's done callback, so this
+        # thread is free for the next job while the upload is in flight
+        _upload_slots.acquire()
         try:
-            # Upload ALL files from job-specific directories using the upload_job_files function
-            # This will include timestamps in folder names and scan all files in the directories
-            # Removed model_set parameter as requested
-            gcp_urls = upload_job_files(job_id, shared_dir)
-            
-            # Store all GCP URLs in the dedicated JSON column
-            if gcp_urls:
-                # Store the JSON directly in the dedicated column
-                job.gcp_urls_json = json.dumps(gcp_urls)
-                logger.info(f"Stored all GCP URLs in dedicated JSON column")
-                
-                # Also store the mixed track URL in the gcp_url field for backward compatibility
-                if any(k for k in gcp_urls.keys() if 'mixed' in k):
-                    # Find the first key containing 'mixed'
-                    mixed_key = next((k for k in gcp_urls.keys() if 'mixed' in k), None)
-                    if mixed_key:
-                        job.gcp_url = gcp_urls[mixed_key]
-                        logger.info(f"Stored GCP URL in job record: {job.gcp_url}")
+            upload_future = upload_executor.submit(upload_job_files, job_id, cfg.shared_dir, file_map=file_map)
+        except BaseException:
+            _upload_slots.release()
+            raise
+        upload_future.add_done_callback(lambda f: _mark_completed(job_id, final_mix, f))
+        # Added last, so the slot is freed once the completion is queued
+        upload_future.add_done_callback(lambda f: _upload_slots.release())
+        logger.info("Job %s handed off to the upload pool", job_id)
+        
+    except Exception as e:
+        logger.error("Error processing job %s: %s", job_id, e, exc_info=True)
+        update_job_state(job_id, status="failed")
+    finally:
+        SessionLocal.remove()
+
+def _mark_completed(job_id, final_mix, upload_future):
+    """
+    Done callback of a job's GCP upload: queue the job's completion together
+    with whatever URLs the upload produced.
+    """
+    gcp_url = None
+    gcp_urls_json = None
+    try:
+        gcp_urls = upload_future.result()
+        
+        # Store all GCP URLs in the dedicated JSON column
+        if gcp_urls:
+            gcp_urls_json = orjson.dumps(gcp_urls).decode()
+            logger.info("Stored all GCP URLs in dedicated JSON column")
             
-        except Exception as e:
-            logger.error(f"Error uploading files to GCP: {str(e)}", exc_info=True)
-            logger.info("Continuing with job processing despite GCP upload failure")
+            # Also store the mixed track URL in the gcp_url field for backward compatibility
+            mixed_key = next((k for k in gcp_urls if 'mixed' in k), None)
+            if mixed_key:
+                gcp_url = gcp_urls[mixed_key]
+                logger.info("Stored GCP URL in job record: %s", gcp_url)
+    except Exception as e:
+        logger.error("Error uploading files to GCP for job %s: %s", job_id, e, exc_info=True)
+        logger.info("Continuing with job processing despite GCP upload failure")
+    
+    # Mark job as completed, keeping any GCP URLs already stored
+    completion = {"status": "completed", "output_file": final_mix}
+    if gcp_url is not None:
+        completion["gcp_url"] = gcp_url
+    if gcp_urls_json is not None:
+        completion["gcp_urls_json"] = gcp_urls_json
+    update_job_state(job_id, **completion)
+    logger.info("Job %s queued to be marked as completed", job_id)
+
+def update_job_state(job_id, **fields):
+    """
+    Queue a change to a job row; the db-writer thread applies it.
+    
+    Args:
+        job_id: ID of the job to update
+        **fields: Column values keyed by the names in STATE_COLUMNS
+    """
+    state_q.put((job_id, fields))
+
+@lru_cache(maxsize=None)
+def _state_update_statement(columns):
+    """
+    Build the UPDATE statement that sets the given tuple of columns.
+    """
+    assignments = ", ".join(f"{column} = {STATE_COLUMNS[column]}" for column in columns)
+    return text(f"UPDATE jobs SET {assignments}, updated_at = now() WHERE id = :id")
+
+def db_writer():
+    """
+    Single consumer of state_q. Every change that arrives within
+    STATE_FLUSH_INTERVAL is written in one transaction on one connection,
+    with one executemany per distinct set of columns.
+    
+    If that transaction fails, each job's change is retried in its own
+    transaction, so one bad row does not lose the others. Changes that still
+    fail are kept and retried with exponential backoff, merged under any
+    newer change for the same job.
+    """
+    running = True
+    # Changes whose write failed, and how often each job's write has failed
+    retry = {}
+    attempts = {}
+    retry_delay = STATE_RETRY_DELAY
+    retry_at = 0
+    while running:
+        try:
+            batch = [state_q.get(timeout=max(0, retry_at - time.monotonic()) if retry else None)]
+        except queue.Empty:
+            batch = []
+        deadline = time.monotonic() + STATE_FLUSH_INTERVAL
+        while batch and len(batch) < STATE_BATCH_SIZE and batch[-1] is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(state_q.get(timeout=remaining))
+            except queue.Empty:
+                break
         
+        # Merge changes per job in queue order so later fields win; changes
+        # waiting for a retry are older than anything just dequeued
+        merged, retry = retry, {}
+        for item in batch:
+            if item is None:
+                running = False
+                continue
+            job_id, fields = item
+            merged.setdefault(job_id, {}).update(fields)
+        if not merged:
+            continue
+        # Hold everything back until the retry is due, unless stopping
+        if running and time.monotonic() < retry_at:
+            retry = merged
+            continue
         
-        # Mark job as completed
-        job.status = "completed"
-        job.updated_at = datetime.datetime.utcnow()
-        session.commit()
-        logger.info(f"Job {job_id} marked as completed")
+        # Group jobs whose changes touch the same columns
+        groups = {}
+        for job_id, fields in merged.items():
+            groups.setdefault(tuple(sorted(fields)), []).append({"id": job_id, **fields})
+        
+        try:
+            with engine.begin() as connection:
+                for columns, rows in groups.items():
+                    connection.execute(_state_update_statement(columns), rows)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Wrote state changes for %s jobs: %s", len(merged), list(merged))
+            for job_id in merged:
+                attempts.pop(job_id, None)
+        except Exception as e:
+            logger.warning("Error writing state changes for %s jobs, retrying each job: %s", len(merged), e)
+            for job_id, fields in merged.items():
+                try:
+                    with engine.begin() as connection:
+                        connection.execute(_state_update_statement(tuple(sorted(fields))), {"id": job_id, **fields})
+                    attempts.pop(job_id, None)
+                except Exception as e:
+                    attempts[job_id] = attempts.get(job_id, 0) + 1
+                    if attempts[job_id] < STATE_MAX_ATTEMPTS:
+                        retry[job_id] = fields
+                    else:
+                        del attempts[job_id]
+                        logger.error("Dropping state change for job %s after %s failed writes: %s %s", job_id, STATE_MAX_ATTEMPTS, fields, e, exc_info=True)
         
+        if not retry:
+            retry_delay = STATE_RETRY_DELAY
+        elif running:
+            logger.warning("Retrying state changes for %s jobs in %s s", len(retry), retry_delay)
+            retry_at = time.monotonic() + retry_delay
+            retry_delay = min(retry_delay * 2, STATE_RETRY_MAX_DELAY)
+        else:
+            logger.error("Stopping with unwritten state changes for jobs: %s", retry)
+
+def stop_db_writer(writer_thread, timeout=5):
+    """
+    Ask the db-writer thread to flush what is queued and exit.
+    """
+    state_q.put(None)
+    writer_thread.join(timeout)
+
+def notify_new_job(session):
+    """
+    Wake up the job worker once the current transaction commits.
+    """
+    session.execute(text(f"NOTIFY {NEW_JOB_CHANNEL}"))
+
+def _listen_for_jobs():
+    """
+    Open a dedicated autocommit connection that LISTENs for new jobs.
+    Returns (raw_connection, dbapi_connection), or None if LISTEN is unavailable.
+    """
+    raw_connection = None
+    try:
+        raw_connection = engine.raw_connection()
+        connection = getattr(raw_connection, "dbapi_connection", None) or raw_connection.connection
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {NEW_JOB_CHANNEL}")
+        logger.info("Listening for new jobs on channel '%s'", NEW_JOB_CHANNEL)
+        return raw_connection, connection
     except Exception as e:
-        logger.error(f"Error processing job {job_id}: {str(e)}", exc_info=True)
-        job.status = "failed"
-        session.commit()
-    finally:
-        session.close()
+        logger.warning("Could not LISTEN on '%s', falling back to polling: %s", NEW_JOB_CHANNEL, e)
+        if raw_connection is not None:
+            # It may already be in autocommit mode, so it must not go back to the pool
+            raw_connection.invalidate()
+        return None
 
-def job_worker(checkpoint, gen_seed, shared_dir):
+def job_worker(cfg, executor, max_workers):
     """
-    Background worker that continuously checks for pending jobs.
+    Background worker that claims pending jobs and submits them to the
+    bounded job executor, never holding more than max_workers at once.
     """
     logger.info("Job worker started")
     
-    # Check if required containers for both model sets are running
-    melody_container_set1 = "melody-generation-set1"
-    vocal_container_set1 = "vocal-mix-set1"
-    melody_container_set2 = "melody-generation-set2"
-    vocal_container_set2 = "vocal-mix-set2"
+    # Probe the containers of both model sets with one inspect
+    container_status = check_containers_running(*SET1_CONTAINERS, *SET2_CONTAINERS)
     
     # Check set1 containers
-    if not check_container_running(melody_container_set1):
-        logger.error(f"Required container '{melody_container_set1}' is not running")
-    
-    if not check_container_running(vocal_container_set1):
-        logger.error(f"Required container '{vocal_container_set1}' is not running")
+    for container_name in SET1_CONTAINERS:
+        if not container_status[container_name]:
+            logger.error("Required container '%s' is not running", container_name)
     
     # Check set2 containers
-    if not check_container_running(melody_container_set2):
-        logger.warning(f"Container '{melody_container_set2}' is not running. Set2 models will not be available.")
+    for container_name in SET2_CONTAINERS:
+        if not container_status[container_name]:
+            logger.warning("Container '%s' is not running. Set2 models will not be available.", container_name)
+    
+    # Jobs claimed by this worker whose future has not finished yet; the
+    # done callback writes to the wake pipe so a freed slot is refilled
+    # without waiting for the next notification
+    in_flight = set()
+    wake_read, wake_write = os.pipe()
+    listener = None
+    listen_retry_delay = LISTEN_RETRY_DELAY
+    listen_retry_at = 0
     
-    if not check_container_running(vocal_container_set2):
-        logger.warning(f"Container '{vocal_container_set2}' is not running. Set2 models will not be available.")
+    def release(job_id):
+        in_flight.discard(job_id)
+        os.write(wake_write, b"\0")
     
     while True:
-        try:
-            session = SessionLocal()
-            pending_jobs = session.query(Job).filter(Job.status == "pending").all()
-            
-            if pending_jobs:
-                logger.info(f"Found {len(pending_jobs)} pending jobs")
-                for job in pending_jobs:
-                    logger.info(f"Starting thread for job {job.id}")
-                    thread = threading.Thread(
-                        target=process_job, 
-                        args=(job.id, checkpoint, gen_seed, shared_dir),
-                        name=f"job-{job.id}"
-                    )
-                    thread.start()
-            else:
-                logger.debug("No pending jobs found")
+        free_slots = max_workers - len(in_flight)
+        if free_slots > 0:
+            try:
+                session = SessionLocal()
+                # Claim pending jobs atomically so several worker processes
+                # never dispatch the same row; rows without an input file are
+                # still being uploaded by the UI
+                claimed_ids = session.execute(CLAIM_PENDING_JOBS, {"n": free_slots}).scalars().all()
+                session.commit()
                 
-            session.close()
-        except Exception as e:
-            logger.error(f"Error in job worker: {str(e)}", exc_info=True)
+                if claimed_ids:
+                    logger.info("Claimed %s pending jobs", len(claimed_ids))
+                    for job_id in claimed_ids:
+                        logger.info("Submitting job %s to the executor", job_id)
+                        in_flight.add(job_id)
+                        future = executor.submit(process_job, job_id, cfg)
+                        future.add_done_callback(lambda f, job_id=job_id: release(job_id))
+                else:
+                    logger.debug("No pending jobs found")
+            except Exception as e:
+                logger.error("Error in job worker: %s", e, exc_info=True)
+            finally:
+                SessionLocal.remove()
         
-        time.sleep(5)
+        # Block until a new job is announced or a slot frees up; the timeout
+        # doubles as a periodic re-scan in case a notification was missed
+        if listener is None and time.monotonic() >= listen_retry_at:
+            listener = _listen_for_jobs()
+            if listener is None:
+                listen_retry_at = time.monotonic() + listen_retry_delay
+                listen_retry_delay = min(listen_retry_delay * 2, LISTEN_RETRY_MAX_DELAY)
+            else:
+                listen_retry_delay = LISTEN_RETRY_DELAY
+        if listener is None:
+            readable, _, _ = select.select([wake_read], [], [], 5)
+        else:
+            raw_connection, connection = listener
+            try:
+                readable, _, _ = select.select([connection, wake_read], [], [], LISTEN_TIMEOUT)
+                if connection in readable:
+                    connection.poll()
+                    connection.notifies.clear()
+            except Exception as e:
+                logger.warning("Lost the %s listener connection: %s", NEW_JOB_CHANNEL, e)
+                raw_connection.invalidate()
+                listener = None
+                readable = []
+        if wake_read in readable:
+            os.read(wake_read, 1024)
 
 def start_worker(checkpoint, gen_seed, shared_dir):
     """
     Start the background worker thread.
     """
-    logger.info(f"Starting worker with checkpoint: {checkpoint}, seed: {gen_seed}, shared_dir: {shared_dir}")
+    cfg = WorkerConfig(checkpoint=checkpoint, gen_seed=gen_seed, shared_dir=shared_dir)
+    logger.info("Starting worker with checkpoint: %s, seed: %s, shared_dir: %s", cfg.checkpoint, cfg.gen_seed, cfg.shared_dir)
+    
+    # Bound the number of jobs processed concurrently; threads are reused
+    max_workers = int(os.getenv("JOB_WORKERS", "4"))
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+    logger.info("Job executor started with %s workers", max_workers)
+    
+    writer_thread = threading.Thread(
+        target=db_writer,
+        daemon=True,
+        name="db-writer"
+    )
+    writer_thread.start()
+    atexit.register(stop_db_writer, writer_thread)
+    
     worker_thread = threading.Thread(
         target=job_worker, 
-        args=(checkpoint, gen_seed, shared_dir), 
+        args=(cfg, executor, max_workers), 
         daemon=True,
         name="job-worker-main"
     )
     worker_thread.start()
-    logger.info(f"Worker thread started: {worker_thread.name}")
\ No newline at end of file
+    logger.info("Worker thread started: %s", worker_thread.name)
@@ -1,201 +1,784 @@
 # This script contains functions to run commands in Docker containers for melody generation and vocal mixing.
 import subprocess
+import selectors
+import collections
+import shutil
 import os
 import logging
 import time
-import json
+import hashlib
 import pathlib
-import importlib.util
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:  # inotify is Linux-only; output waits fall back to polling
+    INotify = None
+
+try:
+    import docker
+except ImportError:  # commands fall back to the docker CLI
+    docker = None
+
+# Model set 2 packages are only installed in images that run it
+try:
+    from melody_generation.infer import create_model
+    import melody_generation.beat_estimation.downbeat_estimation as dbe
+except ImportError:
+    create_model = None
+    dbe = None
+try:
+    from vocalmix.fuwari.core import get_notes_num, make_all_same_char_fuwarare
+    from vocalmix.core import vocalmix
+except ImportError:
+    vocalmix = None
+
+# Model set 2 availability does not change while the process runs; the
+# imports above already searched sys.path, so reuse their outcome
+_HAS_MELODY_GEN = create_model is not None
+_HAS_VOCALMIX = vocalmix is not None
+_SDK_EXISTS = os.path.exists("/app/dreamtonics_sdk")
+_MODEL_CHECKPOINT_PATH = os.environ.get("MODEL_CHECKPOINT_PATH", "/app/checkpoints")
+_MODEL_CONFIG_PATH = os.environ.get("MODEL_CONFIG_PATH", "/app/configs")
+_CHECKPOINT_EXISTS = os.path.exists(_MODEL_CHECKPOINT_PATH)
+_CONFIG_EXISTS = os.path.exists(_MODEL_CONFIG_PATH)
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# Seconds a container status probe is reused before `docker inspect` runs again
+CONTAINER_STATUS_TTL = float(os.environ.get("CONTAINER_STATUS_TTL", "30"))
+# Seconds to keep waiting for a model's output file after its command returns;
+# 0 checks once, since a missing file means the script failed to write it
+OUTPUT_WAIT_SECONDS = float(os.environ.get("OUTPUT_WAIT_SECONDS", "0"))
+# Fixed prefixes of container commands
+_DOCKER_EXEC = ("docker", "exec")
+_UV_RUN = ("uv", "run")
+_MELODY_SCRIPT = (*_UV_RUN, "melody_generation.py")
+_MELODY_FLAGS = (
+    "--one_shot_generation",
+    "--output_beat_estimation_mix",  # Add flag for beat estimation mix
+    "--output_synth_demo"            # Add flag for synth demo
+)
+_VOCALMIX_SCRIPT = (*_UV_RUN, "make_vocalmix.py")
+# Lines of a container command's stdout/stderr kept for the return value and errors
+COMMAND_OUTPUT_TAIL_LINES = 256
+# Longest command output logged or kept in one piece; longer text keeps its head and tail
+COMMAND_LOG_LIMIT = int(os.environ.get("COMMAND_LOG_LIMIT", "65536"))
+# Docker API client shared by all container commands; while the SDK cannot
+# reach the daemon, the CLI is used and the client is retried after a delay
+_docker_api = None
+_docker_api_retry_at = 0.0
+_docker_api_lock = threading.Lock()
+DOCKER_API_RETRY_SECONDS = 60
+_container_status_cache = {}
+_container_status_lock = threading.Lock()
+
+# Names of running containers kept current by the docker events watcher;
+# None while the watcher is not connected
+_running_containers = None
+_container_watcher = None
+# Containers whose status is probed again on the next check even while the
+# watcher is connected, because a command against them failed
+_unverified_containers = set()
+# Seconds before the events watcher reconnects, doubling per failed attempt
+CONTAINER_WATCH_RETRY_DELAY = 5
+CONTAINER_WATCH_RETRY_MAX_DELAY = 300
+
 def check_container_running(container_name):
     """
-    Checks if a container is running.
+    Checks if a container is running. While the docker events watcher is
+    connected this is a set lookup; otherwise the last probe result is
+    reused for CONTAINER_STATUS_TTL seconds.
     Returns True if running, False otherwise.
     """
-    try:
-        result = subprocess.run(
-            ["docker", "inspect", "--format", "{{.State.Running}}", container_name],
-            capture_output=True,
-            text=True,
-            check=False
+    return check_containers_running(container_name)[container_name]
+
+def check_containers_running(*container_names):
+    """
+    Checks several containers at once, running at most one `docker inspect`
+    for all of those without a fresh cached status.
+    Returns a dict mapping each container name to True if running.
+    """
+    # The first check starts the events watcher; until it has listed the
+    # running containers, checks use the inspect cache below
+    if _container_watcher is None:
+        start_container_watcher()
+    running_containers = _running_containers
+    
+    now = time.monotonic()
+    statuses = {}
+    with _container_status_lock:
+        for name in container_names:
+            if running_containers is not None and name not in _unverified_containers:
+                statuses[name] = name in running_containers
+                continue
+            cached = _container_status_cache.get(name)
+            if cached and now - cached[0] < CONTAINER_STATUS_TTL:
+                statuses[name] = cached[1]
+    
+    stale = [name for name in dict.fromkeys(container_names) if name not in statuses]
+    if stale:
+        probed = _inspect_containers_running(stale)
+        now = time.monotonic()
+        with _container_status_lock:
+            for name, is_running in probed.items():
+                _container_status_cache[name] = (now, is_running)
+                _unverified_containers.discard(name)
+                # Correct the watcher's view, e.g. after a missed event
+                if running_containers is not None:
+                    if is_running:
+                        running_containers.add(name)
+                    else:
+                        running_containers.discard(name)
+        statuses.update(probed)
+    return statuses
+
+def invalidate_container_cache(container_name):
+    """
+    Forget the cached status of a container so the next check probes it
+    again, even while the events watcher is connected; used when a command
+    against the container fails.
+    """
+    with _container_status_lock:
+        _container_status_cache.pop(container_name, None)
+        _unverified_containers.add(container_name)
+
+def start_container_watcher():
+    """
+    Start the daemon thread that follows Docker events to keep the set of
+    running containers current. Calling it again is a no-op.
+    """
+    global _container_watcher
+    with _container_status_lock:
+        if _container_watcher is not None:
+            return
+        _container_watcher = threading.Thread(
+            target=_watch_container_events,
+            daemon=True,
+            name="docker-events"
         )
-        
-        if result.returncode != 0:
-            logger.error(f"Container {container_name} does not exist or cannot be inspected")
-            if result.stderr:
-                logger.error(f"Inspect error: {result.stderr}")
-            return False
+    _container_watcher.start()
+
+def _watch_container_events():
+    """
+    Follow container start/die events through the Docker SDK, reconnecting
+    with exponential backoff while the daemon cannot be reached.
+    """
+    global _running_containers
+    if docker is None:
+        logger.info("Docker SDK not installed; container status comes from cached inspects")
+        return
+    retry_delay = CONTAINER_WATCH_RETRY_DELAY
+    while True:
+        events = None
+        try:
+            api = _get_docker_api()
+            if api is None:
+                raise ConnectionError("Docker daemon unavailable")
+            # Subscribe before listing so no change between the two is missed
+            events = api.events(decode=True, filters={"type": "container", "event": ["start", "die"]})
+            running_containers = {
+                name.lstrip("/")
+                for container in api.containers(filters={"status": "running"})
+                for name in container.get("Names", ())
+            }
+            with _container_status_lock:
+                _unverified_containers.clear()
+                _running_containers = running_containers
+            logger.info("Watching docker events; running containers: %s", sorted(running_containers))
+            retry_delay = CONTAINER_WATCH_RETRY_DELAY
+            
+            for event in events:
+                status = event.get("status") or event.get("Action")
+                container_name = event.get("Actor", {}).get("Attributes", {}).get("name")
+                if not container_name:
+                    continue
+                if status == "start":
+                    running_containers.add(container_name)
+                    logger.info("Container %s started", container_name)
+                elif status == "die":
+                    running_containers.discard(container_name)
+                    logger.error("Container %s stopped", container_name)
             
-        is_running = result.stdout.strip().lower() == "true"
-        if not is_running:
-            logger.error(f"Container {container_name} exists but is not running")
+            logger.warning("docker events stream ended")
+        except Exception as e:
+            logger.warning("Error watching docker events, retrying in %ss: %s", retry_delay, e)
+        finally:
+            if events is not None:
+                events.close()
+        
+        # Fall back to cached inspects until the watcher reconnects
+        _running_containers = None
+        time.sleep(retry_delay)
+        retry_delay = min(retry_delay * 2, CONTAINER_WATCH_RETRY_MAX_DELAY)
+
+def _inspect_containers_running(container_names):
+    """
+    Looks up all container_names with one Docker API list call, or one
+    `docker inspect` when the SDK is unavailable.
+    Returns a dict mapping each name to True if running, False otherwise.
+    """
+    statuses = dict.fromkeys(container_names, False)
+    existing = set()
+    try:
+        api = _get_docker_api()
+        if api is not None:
+            # The name filter matches substrings, so keep exact matches only
+            for container in api.containers(all=True, filters={"name": list(container_names)}):
+                for name in container.get("Names", ()):
+                    name = name.lstrip("/")
+                    if name in statuses:
+                        existing.add(name)
+                        statuses[name] = container.get("State") == "running"
         else:
-            logger.info(f"Container {container_name} is running")
+            # Exits non-zero if any name is unknown but still reports the others
+            result = subprocess.run(
+                ["docker", "inspect", "--format", "{{.Name}} {{.State.Running}}", *container_names],
+                capture_output=True,
+                text=True,
+                check=False
+            )
+            
+            for line in result.stdout.splitlines():
+                name, _, running = line.strip().partition(" ")
+                name = name.lstrip("/")
+                if name in statuses:
+                    existing.add(name)
+                    statuses[name] = running.lower() == "true"
+            if result.returncode != 0 and result.stderr:
+                logger.error("Inspect error: %s", result.stderr)
+        
+        for name in container_names:
+            if statuses[name]:
+                logger.info("Container %s is running", name)
+            elif name in existing:
+                logger.error("Container %s exists but is not running", name)
+            else:
+                logger.error("Container %s does not exist or cannot be inspected", name)
         
-        return is_running
+        return statuses
         
     except Exception as e:
-        logger.error(f"Error checking container status: {str(e)}", exc_info=True)
-        return False
+        logger.error("Error checking container status: %s", e, exc_info=True)
+        return statuses
+
+def _get_docker_api():
+    """
+    Return a low-level Docker API client that keeps its connection to the
+    daemon socket open across calls, or None if the SDK or daemon is
+    unavailable, in which case commands go through the docker CLI.
+    """
+    global _docker_api, _docker_api_retry_at
+    if docker is None:
+        return None
+    with _docker_api_lock:
+        if _docker_api is None and time.monotonic() >= _docker_api_retry_at:
+            try:
+                api = docker.from_env().api
+                api.ping()
+                _docker_api = api
+            except Exception as e:
+                logger.warning("Docker SDK unavailable, using the docker CLI for %ss: %s", DOCKER_API_RETRY_SECONDS, e)
+                _docker_api_retry_at = time.monotonic() + DOCKER_API_RETRY_SECONDS
+    return _docker_api
+
+def _truncate(s, n=None):
+    """
+    Shortens s (str or bytes) to about n characters, keeping its head and
+    tail, so multi-MB command output is not copied through the log formatter.
+    n defaults to COMMAND_LOG_LIMIT.
+    """
+    n = COMMAND_LOG_LIMIT if n is None else n
+    if len(s) <= n:
+        return s
+    marker = "\n...[truncated]...\n"
+    if isinstance(s, bytes):
+        marker = marker.encode()
+    return s[:n // 2] + marker + s[-(n // 2):]
+
+def _collect_lines(stream_name, pending, chunk, tail):
+    """
+    Log and keep each complete line of pending + chunk. Lines are kept as
+    bytes and only decoded to be logged, or once the command has finished.
+    An empty chunk marks the end of the stream and flushes the remainder.
+    Returns the bytes of the unterminated last line.
+    """
+    data = pending + chunk
+    if chunk:
+        *lines, pending = data.split(b"\n")
+    else:
+        lines, pending = ([data] if data else []), b""
+    log_lines = logger.isEnabledFor(logging.INFO)
+    for line in lines:
+        # Progress bars redraw with \r and can make one line huge
+        line = _truncate(line).rstrip(b"\r")
+        tail.append(line)
+        if log_lines:
+            logger.info("Command %s: %s", stream_name, line.decode(errors="replace"))
+    return pending
+
+def _exec_with_api(api, container_name, command_list, tails):
+    """
+    Run command_list in the container through the Docker API, streaming its
+    output into tails. Returns the exit code.
+    """
+    exec_id = api.exec_create(container_name, command_list, stdout=True, stderr=True)["Id"]
+    pending = {"stdout": b"", "stderr": b""}
+    for stdout_chunk, stderr_chunk in api.exec_start(exec_id, stream=True, demux=True):
+        if stdout_chunk:
+            pending["stdout"] = _collect_lines("stdout", pending["stdout"], stdout_chunk, tails["stdout"])
+        if stderr_chunk:
+            pending["stderr"] = _collect_lines("stderr", pending["stderr"], stderr_chunk, tails["stderr"])
+    for stream_name, rest in pending.items():
+        _collect_lines(stream_name, rest, b"", tails[stream_name])
+    return api.exec_inspect(exec_id)["ExitCode"]
+
+def _exec_with_cli(full_command, tails):
+    """
+    Run full_command with the docker CLI, streaming its output into tails.
+    Returns the exit code.
+    """
+    process = subprocess.Popen(
+        full_command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    
+    # Read raw bytes so a partial line on one pipe never blocks the other
+    pending = {"stdout": b"", "stderr": b""}
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ, "stdout")
+        selector.register(process.stderr, selectors.EVENT_READ, "stderr")
+        while selector.get_map():
+            for key, _ in selector.select():
+                stream_name = key.data
+                chunk = os.read(key.fileobj.fileno(), 65536)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                pending[stream_name] = _collect_lines(stream_name, pending[stream_name], chunk, tails[stream_name])
+    return process.wait()
 
 def run_command_in_container(container_name, command_list):
     """
-    Runs a command inside a specified container using `docker exec`
-    and returns the command's stdout.
+    Runs a command inside a specified container, through the Docker API when
+    available and `docker exec` otherwise, logging its output line by line
+    as it is produced.
+    Returns the last COMMAND_OUTPUT_TAIL_LINES lines of the command's stdout.
     """
-    full_command = ["docker", "exec", container_name] + command_list
-    logger.info(f"Running command: {' '.join(full_command)}")
+    full_command = (*_DOCKER_EXEC, container_name, *command_list)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Running command: %s", " ".join(full_command))
+    
+    # Keep only the tail of each stream instead of the whole output
+    tails = {
+        "stdout": collections.deque(maxlen=COMMAND_OUTPUT_TAIL_LINES),
+        "stderr": collections.deque(maxlen=COMMAND_OUTPUT_TAIL_LINES),
+    }
     
     try:
-        result = subprocess.run(
-            full_command, 
-            capture_output=True, 
-            text=True, 
-            check=False  # Don't raise an exception on non-zero exit
-        )
-        
-        # Log the output regardless of success or failure
-        if result.stdout:
-            logger.info(f"Command stdout: {result.stdout}")
+        api = _get_docker_api()
+        if api is not None:
+            returncode = _exec_with_api(api, container_name, command_list, tails)
+        else:
+            returncode = _exec_with_cli(full_command, tails)
+        stdout = b"\n".join(tails["stdout"]).decode(errors="replace")
         
         # Check if the command failed
-        if result.returncode != 0:
-            logger.error(f"Command failed with exit code {result.returncode}")
-            if result.stderr:
-                logger.error(f"Command stderr: {result.stderr}")
+        if returncode != 0:
+            stderr = b"\n".join(tails["stderr"]).decode(errors="replace")
+            logger.error("Command failed with exit code %s", returncode)
+            if returncode == 137:
+                # 128 + SIGKILL, which in a model container is almost always the OOM killer
+                logger.error("Command in %s was killed by SIGKILL, most likely out of memory", container_name)
+            if stderr:
+                logger.error("Command stderr (last %s lines): %s", COMMAND_OUTPUT_TAIL_LINES, _truncate(stderr))
+            raise subprocess.CalledProcessError(returncode, full_command, stdout, stderr)
             
-            # Now raise the exception
-            result.check_returncode()  # This will raise CalledProcessError
-            
-        return result.stdout
+        return stdout
         
     except subprocess.CalledProcessError as e:
-        logger.error(f"Command execution failed: {str(e)}")
-        if e.stdout:
-            logger.info(f"Command stdout: {e.stdout}")
-        if e.stderr:
-            logger.error(f"Command stderr: {e.stderr}")
+        logger.error("Command execution failed: %s", e)
+        # docker exec exits with 125 when the container itself is unusable
+        if e.returncode == 125:
+            invalidate_container_cache(container_name)
         raise
     except Exception as e:
-        logger.error(f"Unexpected error running command: {str(e)}", exc_info=True)
+        logger.error("Unexpected error running command: %s", e, exc_info=True)
+        invalidate_container_cache(container_name)
         raise
 
-def generate_melody(input_bgm, checkpoint, gen_seed, output_dir, start_time=0, bpm=0, container_name="melody-generation-set1"):
+def _watch_dir(directory):
+    """
+    Start an inotify watch for files finished in or moved into directory.
+    CREATE is not watched: it fires before the writer has filled the file.
+    Returns the INotify instance, or None if inotify is unavailable.
+    """
+    if INotify is None:
+        return None
+    try:
+        watch = INotify()
+        watch.add_watch(directory, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+        return watch
+    except OSError as e:
+        logger.warning("Could not watch %s, falling back to polling: %s", directory, e)
+        return None
+
+def _missing_files(*checks):
+    """
+    Stat each (label, path, needed) whose needed flag is set, skipping the
+    ones a caller already verified.
+    Returns "<label> <path>" for every file that does not exist.
+    """
+    return [f"{label} {path}" for label, path, needed in checks if needed and not os.path.exists(path)]
+
+def _has_content(path):
+    """Return True if path exists and is not empty, with a single stat."""
+    try:
+        return os.stat(path).st_size > 0
+    except FileNotFoundError:
+        return False
+
+def _wait_for_file(path, watch=None, timeout=30):
+    """
+    Wait up to timeout seconds for path to exist with some content; an
+    empty file is one the model has not written yet (or failed to).
+    
+    Args:
+        path: File to wait for
+        watch: INotify watching the file's directory, or None to poll with backoff
+        timeout: Seconds to wait before giving up
+        
+    Returns:
+        True if the file exists and is non-empty, False if it did not appear in time.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    name = os.path.basename(path)
+    waited = False
+    delay = 0.05
+    try:
+        # Checked first to cover a file created before the watch started
+        check = True
+        while True:
+            if check and _has_content(path):
+                if waited:
+                    logger.info("%s appeared after %.2fs", path, time.monotonic() - start)
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning("%s did not appear within %.2fs", path, time.monotonic() - start)
+                return False
+            waited = True
+            if watch is None:
+                # Back off exponentially so a file that shows up quickly is
+                # seen quickly, without polling a slow volume too often
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 1.0)
+            else:
+                # Only re-check when an event names the file we wait for
+                events = watch.read(timeout=int(remaining * 1000))
+                check = any(event.name == name for event in events)
+    finally:
+        if watch is not None:
+            watch.close()
+
+def generate_melody(input_bgm, checkpoint, gen_seed, output_dir, start_time=0, bpm=0, container_name="melody-generation-set1", input_size=None, container_running=None):
     """
     Triggers the melody generation model.
     - input_bgm: Path to the original background music file (in the shared volume)
     - checkpoint: Path to the GETMusic checkpoint (inside the melody container)
     - gen_seed: The seed for generation
-    - output_dir: The output directory for melody files
+    - output_dir: The output directory for melody files (must already exist)
     - start_time: Song start time in seconds
     - bpm: Beats per minute
     - container_name: Name of the container to use (default: "melody-generation-set1")
+    - input_size: Size of input_bgm if the caller already stat'ed it; skips the existence check
+    - container_running: Status of container_name if the caller already checked it
     Returns the path to the generated melody MIDI file.
     """
-    # Check if container is running
-    if not check_container_running(container_name):
+    # Check if container is running, unless the caller already did
+    if container_running is None:
+        container_running = check_container_running(container_name)
+    if not container_running:
         raise RuntimeError(f"Required container '{container_name}' is not running")
     
-    # Create output directory
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Check if input file exists
-    if not os.path.exists(input_bgm):
+    # Check if input file exists, unless the caller already did
+    if input_size is None and not os.path.exists(input_bgm):
         raise FileNotFoundError(f"Input file {input_bgm} does not exist")
     
-    logger.info(f"Generating melody for {input_bgm} with seed {gen_seed} to {output_dir}")
-    logger.info(f"Using start_time={start_time}, bpm={bpm}")
+    logger.info("Generating melody for %s with seed %s to %s", input_bgm, gen_seed, output_dir)
+    logger.info("Using start_time=%s, bpm=%s", start_time, bpm)
     
     # Build the command
-    command = [
-        "uv", "run", "melody_generation.py",
+    command = (
+        *_MELODY_SCRIPT,
         "--load_path", checkpoint,
         "--bgm_filepath", input_bgm,
         "--gen_seed", str(gen_seed),
         "--output_dir", output_dir,
-        "--one_shot_generation",
-        "--output_beat_estimation_mix",  # Add flag for beat estimation mix
-        "--output_synth_demo"            # Add flag for synth demo
-    ]
+        *_MELODY_FLAGS
+    )
     
     # Only add start_time and bpm if at least one is non-zero
-    if start_time > 0 or bpm > 0:
-        # According to the README, if start_time is specified, bpm must also be specified
-        if start_time > 0:
-            command.extend(["--start_time", str(start_time)])
-            command.extend(["--bpm", str(bpm)])
-        elif bpm > 0:
-            # If only BPM is specified (start_time=0), still pass both parameters
-            command.extend(["--start_time", "0"])
-            command.extend(["--bpm", str(bpm)])
+    # According to the README, if start_time is specified, bpm must also be specified
+    if start_time > 0:
+        command = (*command, "--start_time", str(start_time), "--bpm", str(bpm))
+    elif bpm > 0:
+        # If only BPM is specified (start_time=0), still pass both parameters
+        command = (*command, "--start_time", "0", "--bpm", str(bpm))
     
-    run_command_in_container(container_name, command)
+    # docker exec returns after the script exits, so the file normally exists
+    # by then; only watch for it when a grace period is configured
+    melody_file = os.path.join(output_dir, "melody.mid")
+    watch = _watch_dir(output_dir) if OUTPUT_WAIT_SECONDS > 0 else None
+    try:
+        run_command_in_container(container_name, command)
+    except Exception:
+        if watch is not None:
+            watch.close()
+        raise
     
     # Check if melody file was created
-    melody_file = os.path.join(output_dir, "melody.mid")
-    wait_attempts = 10
-    for attempt in range(wait_attempts):
-        if os.path.exists(melody_file):
-            logger.info(f"Melody file generated at: {melody_file}")
-            return melody_file
-        
-        logger.warning(f"Melody file not found yet, waiting... (attempt {attempt+1}/{wait_attempts})")
-        time.sleep(3)
+    if _wait_for_file(melody_file, watch, OUTPUT_WAIT_SECONDS):
+        logger.info("Melody file generated at: %s", melody_file)
+        return melody_file
     
-    raise FileNotFoundError(f"Melody file {melody_file} was not created after waiting")
+    raise FileNotFoundError(f"Melody file {melody_file} was not created by {container_name}")
 
-def mix_vocals(original_bgm, melody_file, output_dir, container_name="vocal-mix-set1", sex="female"):
+def mix_vocals(original_bgm, melody_file, output_dir, container_name="vocal-mix-set1", sex="female", container_running=None, input_size=None, melody_checked=False):
     """
     Triggers the vocal mix model.
     - original_bgm: Path to the original BGM file (in the shared volume)
     - melody_file: Path to the generated melody MIDI file
-    - output_dir: The output directory for vocal files
+    - output_dir: The output directory for vocal files (must already exist)
     - container_name: Name of the container to use (default: "vocal-mix-set1")
     - sex: Voice type to use ("female" or "male")
+    - container_running: Status of container_name if the caller already checked it
+    - input_size: Size of original_bgm if the caller already stat'ed it; skips its existence check
+    - melody_checked: True if the caller already saw melody_file; skips its existence check
     Returns the path to the final mixed track.
     """
-    # Check if container is running
-    if not check_container_running(container_name):
+    # Check if container is running, unless the caller already did
+    if container_running is None:
+        container_running = check_container_running(container_name)
+    if not container_running:
         raise RuntimeError(f"Required container '{container_name}' is not running")
     
-    # Create output directory
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Check if input files exist
-    if not os.path.exists(original_bgm):
-        raise FileNotFoundError(f"Original BGM file {original_bgm} does not exist")
-    
-    if not os.path.exists(melody_file):
-        raise FileNotFoundError(f"Melody file {melody_file} does not exist")
+    # Check the input files the caller has not already checked, reporting
+    # every missing one at once
+    missing = _missing_files(
+        ("Original BGM file", original_bgm, input_size is None),
+        ("Melody file", melody_file, not melody_checked),
+    )
+    if missing:
+        raise FileNotFoundError(f"{', '.join(missing)} does not exist")
     
-    logger.info(f"Mixing vocals for {original_bgm} with melody {melody_file} to {output_dir}")
+    logger.info("Mixing vocals for %s with melody %s to %s", original_bgm, melody_file, output_dir)
     
-    command = [
-        "uv", "run", "make_vocalmix.py",
+    command = (
+        *_VOCALMIX_SCRIPT,
         "--bgm_filepath", original_bgm,
         "--melody_filepath", melody_file,
         "--all_la",
         "--sex", sex,
         "--write_dirpath", output_dir
-    ]
+    )
     
-    run_command_in_container(container_name, command)
+    # docker exec returns after the script exits, so the file normally exists
+    # by then; only watch for it when a grace period is configured
+    mix_file = os.path.join(output_dir, "mix.wav")
+    watch = _watch_dir(output_dir) if OUTPUT_WAIT_SECONDS > 0 else None
+    try:
+        run_command_in_container(container_name, command)
+    except Exception:
+        if watch is not None:
+            watch.close()
+        raise
     
     # Check if mix file was created
-    mix_file = os.path.join(output_dir, "mix.wav")
-    wait_attempts = 10
-    for attempt in range(wait_attempts):
-        if os.path.exists(mix_file):
-            logger.info(f"Mix file generated at: {mix_file}")
-            return mix_file
-        
-        logger.warning(f"Mix file not found yet, waiting... (attempt {attempt+1}/{wait_attempts})")
-        time.sleep(3)
+    if _wait_for_file(mix_file, watch, OUTPUT_WAIT_SECONDS):
+        logger.info("Mix file generated at: %s", mix_file)
+        return mix_file
+    
+    raise FileNotFoundError(f"Mix file {mix_file} was not created by {container_name}")
+
+def place_file(src, dst, keep_source=False, copy=False):
+    """
+    Make the file at src available at dst without copying its bytes when
+    possible: hard link first, then rename, and copy only as a last resort.
+    dst is only ever replaced atomically, so a failed attempt never leaves
+    it missing.
     
-    raise FileNotFoundError(f"Mix file {mix_file} was not created after waiting")
+    Args:
+        src: Path of the file to place
+        dst: Path to make it available at
+        keep_source: If True, src is never renamed away; a copy is made
+            when linking fails
+        copy: If True, always copy; for sources that are rewritten in place
+            later, whose new contents a hard link would share
+    
+    Returns:
+        "Kept", "Linked", "Moved" or "Copied", for logging
+    """
+    # A path that differs from dst only as a string (./, //, a symlinked
+    # directory) may already be the same file; replacing it would lose it
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return "Kept"
+    
+    if not copy:
+        # Link under a temporary name next to dst, then rename it over dst
+        tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.link(src, tmp)
+        except OSError:
+            pass
+        else:
+            try:
+                os.replace(tmp, dst)
+                return "Linked"
+            except OSError:
+                os.unlink(tmp)
+        if not keep_source:
+            try:
+                os.replace(src, dst)
+                return "Moved"
+            except OSError:
+                pass
+    shutil.copy2(src, dst)
+    return "Copied"
+
+# Serialize first-time loads of each model so concurrent jobs do not load
+# it twice; separate locks let the two models load in parallel
+_gen_model_lock = threading.Lock()
+_dbe_model_lock = threading.Lock()
+# Loads the downbeat model while the melody model is being loaded
+_model_loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-loader")
+
+def _advise_sequential(path):
+    """
+    Tell the kernel the checkpoint file at path will be read sequentially
+    and soon, so it reads ahead aggressively on a cold page cache. A
+    directory is skipped: which of its files create_model reads is not
+    known here, and advising all of them could pull unrelated checkpoints
+    into the page cache.
+    """
+    if not hasattr(os, "posix_fadvise") or not os.path.isfile(path):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError as e:
+        logger.debug("posix_fadvise failed for %s: %s", path, e)
+    finally:
+        os.close(fd)
+
+@lru_cache(maxsize=4)
+def _load_gen_model(checkpoint_path, config_path):
+    logger.info("Loading melody generation model from %s", checkpoint_path)
+    _advise_sequential(checkpoint_path)
+    return create_model(checkpoint_path=pathlib.Path(checkpoint_path), config_path=pathlib.Path(config_path))
+
+def _get_gen_model(checkpoint_path, config_path):
+    """
+    Return the melody generation model for a checkpoint/config pair,
+    loading it on first use and reusing it afterwards. Paths are cached as
+    strings, so str and pathlib.Path arguments share one entry.
+    """
+    with _gen_model_lock:
+        return _load_gen_model(os.fspath(checkpoint_path), os.fspath(config_path))
+
+@lru_cache(maxsize=1)
+def _load_dbe_model():
+    logger.info("Loading downbeat estimation model")
+    return dbe.create_model()
+
+def _get_dbe_model():
+    """
+    Return the downbeat estimation model, loading it on first use.
+    """
+    with _dbe_model_lock:
+        return _load_dbe_model()
+
+def _model_cache_clear():
+    """
+    Drop the cached models so the next job loads them again, e.g. after a
+    checkpoint was replaced on disk.
+    """
+    with _gen_model_lock:
+        _load_gen_model.cache_clear()
+    with _dbe_model_lock:
+        _load_dbe_model.cache_clear()
+
+# Beat estimates of recent inputs: (audio digest, manual, start_time, bpm) -> estimate
+BEAT_ESTIMATE_CACHE_SIZE = 32
+_beat_estimate_cache = collections.OrderedDict()
+_beat_estimate_lock = threading.Lock()
+
+def _file_digest(path):
+    """
+    Return a BLAKE2b digest of the file's contents, so the same audio
+    uploaded again under another name is recognized.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _estimate_beats(dbe_model, input_bgm_path, start_time, bpm):
+    """
+    Run downbeat estimation for input_bgm_path, reusing the result of an
+    earlier job with the same audio, start_time and bpm.
+    
+    Args:
+        dbe_model: Downbeat estimation model
+        input_bgm_path: pathlib.Path of the BGM file
+        start_time: Song start time in seconds (0 for automatic estimation)
+        bpm: Beats per minute (0 for automatic estimation)
+        
+    Returns:
+        The estimate, as passed to the melody model's infer()
+    """
+    # Manual beat estimation when either is given; unless both are, the song starts at 0
+    manual = start_time > 0 or bpm > 0
+    if not (start_time > 0 and bpm > 0):
+        start_time = 0
+    
+    key = (_file_digest(input_bgm_path), manual, start_time, bpm)
+    with _beat_estimate_lock:
+        dbe_res = _beat_estimate_cache.get(key)
+        if dbe_res is not None:
+            _beat_estimate_cache.move_to_end(key)
+    # An estimate written to a file is only reusable while the file is there
+    if dbe_res is not None and (not isinstance(dbe_res, (str, os.PathLike)) or os.path.exists(dbe_res)):
+        logger.info("Reusing beat estimation for %s (start_time=%s, bpm=%s)", input_bgm_path, start_time, bpm)
+        return dbe_res
+    
+    if manual:
+        dbe_res = dbe_model.estimate(
+            audio_filepath=input_bgm_path,
+            start_time=start_time,
+            bpm=bpm,
+            auto_estimate=False
+        )
+    else:
+        # Automatic beat estimation
+        dbe_res = dbe_model.estimate(audio_filepath=input_bgm_path)
+    
+    with _beat_estimate_lock:
+        _beat_estimate_cache[key] = dbe_res
+        _beat_estimate_cache.move_to_end(key)
+        while len(_beat_estimate_cache) > BEAT_ESTIMATE_CACHE_SIZE:
+            _beat_estimate_cache.popitem(last=False)
+    return dbe_res
 
 def generate_melody_with_package(input_bgm, checkpoint, gen_seed, output_dir, start_time=0, bpm=0):
     """
@@ -205,7 +788,7 @@ def generate_melody_with_package(input_bgm, checkpoint, gen_seed, output_dir, st
         input_bgm: Path to the original background music file
         checkpoint: Path to the checkpoint file
         gen_seed: The seed for generation
-        output_dir: The output directory for melody files
+        output_dir: The output directory for melody files (must already exist)
         start_time: Song start time in seconds
         bpm: Beats per minute
         
@@ -214,53 +797,24 @@ def generate_melody_with_package(input_bgm, checkpoint, gen_seed, output_dir, st
     """
     try:
         # Check if the package is installed
-        if importlib.util.find_spec("melody_generation") is None:
+        if create_model is None:
             raise ImportError("melody_generation package is not installed")
         
-        # Import the required modules
-        from melody_generation.infer import create_model
-        import melody_generation.beat_estimation.downbeat_estimation as dbe
-        
         logger.info(f"Generating melody using Python package for {input_bgm} with seed {gen_seed}")
         logger.info(f"Using start_time={start_time}, bpm={bpm}")
         
-        # Create output directory
-        os.makedirs(output_dir, exist_ok=True)
-        
         # Convert paths to pathlib.Path objects
         input_bgm_path = pathlib.Path(input_bgm)
         checkpoint_path = pathlib.Path(checkpoint)
         output_dir_path = pathlib.Path(output_dir)
         
-        # Create the model
-        gen_model = create_model(
-            checkpoint_path=checkpoint_path,
-            config_path=pathlib.Path("configs/20250507_test2300_270000.yaml") 
-        )
+        # Get the models, loading them only on first use; the downbeat model
+        # loads on another thread while the melody model's weights are read
+        dbe_future = _model_loader.submit(_get_dbe_model)
+        gen_model = _get_gen_model(checkpoint_path, pathlib.Path("configs/20250507_test2300_270000.yaml"))
         
-        # Handle beat estimation
-        if start_time > 0 or bpm > 0:
-            # Manual beat estimation
-            dbe_model = dbe.create_model()
-            if start_time > 0 and bpm > 0:
-                dbe_res = dbe_model.estimate(
-                    audio_filepath=input_bgm_path,
-                    start_time=start_time,
-                    bpm=bpm,
-                    auto_estimate=False
-                )
-            else:
-                # Only BPM is specified
-                dbe_res = dbe_model.estimate(
-                    audio_filepath=input_bgm_path,
-                    start_time=0,
-                    bpm=bpm,
-                    auto_estimate=False
-                )
-        else:
-            # Automatic beat estimation
-            dbe_model = dbe.create_model()
-            dbe_res = dbe_model.estimate(audio_filepath=input_bgm_path)
+        # Handle beat estimation, reusing an earlier estimate of the same audio
+        dbe_res = _estimate_beats(dbe_future.result(), input_bgm_path, start_time, bpm)
         
         # Generate melody
         seeds = [gen_seed] if gen_seed != 0 else None
@@ -281,9 +835,8 @@ def generate_melody_with_package(input_bgm, checkpoint, gen_seed, output_dir, st
         # Copy the melody file to the expected location if it's not already there
         expected_melody_file = os.path.join(output_dir, "melody.mid")
         if str(melody_file) != expected_melody_file:
-            import shutil
-            shutil.copy2(melody_file, expected_melody_file)
-            logger.info(f"Copied melody file to: {expected_melody_file}")
+            action = place_file(melody_file, expected_melody_file)
+            logger.info(f"{action} melody file at: {expected_melody_file}")
             melody_file = expected_melody_file
         
         return melody_file
@@ -299,7 +852,7 @@ def mix_vocals_with_package(original_bgm, melody_file, output_dir, sex="female")
     Args:
         original_bgm: Path to the original BGM file
         melody_file: Path to the generated melody MIDI file
-        output_dir: The output directory for vocal files
+        output_dir: The output directory for vocal files (must already exist)
         sex: Voice type to use ("female" or "male")
         
     Returns:
@@ -307,18 +860,11 @@ def mix_vocals_with_package(original_bgm, melody_file, output_dir, sex="female")
     """
     try:
         # Check if the package is installed
-        if importlib.util.find_spec("vocalmix") is None:
+        if vocalmix is None:
             raise ImportError("vocalmix package is not installed")
         
-        # Import the required modules
-        from vocalmix.fuwari.core import get_notes_num, make_all_same_char_fuwarare
-        from vocalmix.core import vocalmix
-        
         logger.info(f"Mixing vocals using Python package for {original_bgm} with melody {melody_file}")
         
-        # Create output directory
-        os.makedirs(output_dir, exist_ok=True)
-        
         # Convert paths to pathlib.Path objects
         original_bgm_path = pathlib.Path(original_bgm)
         melody_file_path = pathlib.Path(melody_file)
@@ -349,17 +895,15 @@ def mix_vocals_with_package(original_bgm, melody_file, output_dir, sex="female")
         # Copy the mix file to the expected location if it's not already there
         expected_mix_file = os.path.join(output_dir, "mix.wav")
         if str(mix_path) != expected_mix_file:
-            import shutil
-            shutil.copy2(mix_path, expected_mix_file)
-            logger.info(f"Copied mix file to: {expected_mix_file}")
+            action = place_file(mix_path, expected_mix_file)
+            logger.info(f"{action} mix file at: {expected_mix_file}")
             mix_path = expected_mix_file
         
         # Also copy the vocal file to the expected location
         expected_vocal_file = os.path.join(output_dir, "vocal.wav")
         if str(vocal_path) != expected_vocal_file:
-            import shutil
-            shutil.copy2(vocal_path, expected_vocal_file)
-            logger.info(f"Copied vocal file to: {expected_vocal_file}")
+            action = place_file(vocal_path, expected_vocal_file)
+            logger.info(f"{action} vocal file at: {expected_vocal_file}")
         
         return mix_path
         
@@ -367,7 +911,73 @@ def mix_vocals_with_package(original_bgm, melody_file, output_dir, sex="female")
         logger.error(f"Error mixing vocals with package: {str(e)}", exc_info=True)
         raise
 
-def process_song(shared_dir, input_bgm, checkpoint, gen_seed, job_id=None, start_time=0, bpm=0, model_set="set1", sex="female"):
+class SongPaths(NamedTuple):
+    """Output locations of one song for one model set."""
+    melody_dir: str
+    vocal_dir: str
+    beat_mix: str
+
+def _make_paths(shared_dir, model_set, job_id=None):
+    """
+    Build the output paths for a song, inside job_<job_id> subdirectories
+    when a job_id is given.
+    """
+    melody_dir = os.path.join(shared_dir, f"melody_results_{model_set}")
+    vocal_dir = os.path.join(shared_dir, f"vocal_results_{model_set}")
+    if job_id:
+        melody_dir = os.path.join(melody_dir, f"job_{job_id}")
+        vocal_dir = os.path.join(vocal_dir, f"job_{job_id}")
+    return SongPaths(melody_dir, vocal_dir, os.path.join(melody_dir, "beat_mixed_synth_mix.wav"))
+
+def _list_dir(directory):
+    """
+    Return the names in directory from a single scandir, or an empty set
+    if it does not exist.
+    """
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries}
+    except FileNotFoundError:
+        return set()
+
+def _find_beat_mix(beat_mix_file, names):
+    """
+    Return beat_mix_file if melody generation wrote it, else None.
+    names is the listing of its directory from _list_dir.
+    """
+    if os.path.basename(beat_mix_file) in names:
+        logger.info("Beat mix file found at: %s", beat_mix_file)
+        return beat_mix_file
+    logger.warning("Beat mix file not found at: %s", beat_mix_file)
+    return None
+
+# Parent directories (e.g. melody_results_set1) already created by this process
+_ready_parent_dirs = set()
+_ready_parent_dirs_lock = threading.Lock()
+
+def _ensure_dirs(*paths):
+    """
+    Create each distinct directory in paths if missing. Parents are created
+    once per process under a lock, so concurrent jobs only mkdir their own
+    leaf directory.
+    """
+    for path in dict.fromkeys(paths):
+        parent = os.path.dirname(path)
+        if parent not in _ready_parent_dirs:
+            with _ready_parent_dirs_lock:
+                if parent not in _ready_parent_dirs:
+                    os.makedirs(parent, exist_ok=True)
+                    _ready_parent_dirs.add(parent)
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            pass
+        except FileNotFoundError:
+            # The parent was removed after it was created; recreate the chain
+            _ready_parent_dirs.discard(parent)
+            os.makedirs(path, exist_ok=True)
+
+def process_song(shared_dir, input_bgm, checkpoint, gen_seed, job_id=None, start_time=0, bpm=0, model_set="set1", sex="female", input_size=None):
     """
     Orchestrates the complete workflow:
       1. Runs melody generation.
@@ -384,43 +994,39 @@ def process_song(shared_dir, input_bgm, checkpoint, gen_seed, job_id=None, start
         bpm: Beats per minute
         model_set: Which model set to use ('set1' or 'set2', defaults to 'set1')
         sex: Voice type to use ("female" or "male")
+        input_size: Size of input_bgm in bytes if already known from a stat
     """
     try:
-        # Create job-specific output directories if job_id is provided
-        if job_id:
-            melody_output_dir = os.path.join(shared_dir, f"melody_results_{model_set}", f"job_{job_id}")
-            vocal_output_dir = os.path.join(shared_dir, f"vocal_results_{model_set}", f"job_{job_id}")
-        else:
-            melody_output_dir = os.path.join(shared_dir, f"melody_results_{model_set}")
-            vocal_output_dir = os.path.join(shared_dir, f"vocal_results_{model_set}")
-            
-        # Create directories if they don't exist
-        os.makedirs(melody_output_dir, exist_ok=True)
-        os.makedirs(vocal_output_dir, exist_ok=True)
+        # Output paths, job-specific if job_id is provided; the directories
+        # are created below, once the model set to use is settled
+        paths = _make_paths(shared_dir, model_set, job_id)
         
         # Determine which approach to use based on model_set
         if model_set == 'set2':
             # Check if required packages are installed
-            melody_gen_installed = importlib.util.find_spec("melody_generation") is not None
-            vocalmix_installed = importlib.util.find_spec("vocalmix") is not None
+            melody_gen_installed = _HAS_MELODY_GEN
+            vocalmix_installed = _HAS_VOCALMIX
             
             # Check if required files exist
-            sdk_exists = os.path.exists("/app/dreamtonics_sdk")
+            sdk_exists = _SDK_EXISTS
             
             # Get the checkpoint path from environment variable if available
-            model_checkpoint_path = os.environ.get("MODEL_CHECKPOINT_PATH", "/app/checkpoints")
-            model_config_path = os.environ.get("MODEL_CONFIG_PATH", "/app/configs")
+            model_checkpoint_path = _MODEL_CHECKPOINT_PATH
+            model_config_path = _MODEL_CONFIG_PATH
             
-            checkpoint_exists = os.path.exists(model_checkpoint_path)
-            config_exists = os.path.exists(model_config_path)
+            checkpoint_exists = _CHECKPOINT_EXISTS
+            config_exists = _CONFIG_EXISTS
             
             # Log the status of all requirements
-            logger.info(f"Model set 2 requirements check:")
-            logger.info(f"  - melody_generation package: {'installed' if melody_gen_installed else 'NOT INSTALLED'}")
-            logger.info(f"  - vocalmix package: {'installed' if vocalmix_installed else 'NOT INSTALLED'}")
-            logger.info(f"  - Dreamtonics SDK: {'exists' if sdk_exists else 'NOT FOUND'}")
-            logger.info(f"  - Model checkpoint: {'exists' if checkpoint_exists else 'NOT FOUND'} at {model_checkpoint_path}")
-            logger.info(f"  - Model config: {'exists' if config_exists else 'NOT FOUND'} at {model_config_path}")
+            logger.info(
+                "Model set 2 requirements check: melody_generation package: %s, vocalmix package: %s, "
+                "Dreamtonics SDK: %s, model checkpoint: %s at %s, model config: %s at %s",
+                "installed" if melody_gen_installed else "NOT INSTALLED",
+                "installed" if vocalmix_installed else "NOT INSTALLED",
+                "exists" if sdk_exists else "NOT FOUND",
+                "exists" if checkpoint_exists else "NOT FOUND", model_checkpoint_path,
+                "exists" if config_exists else "NOT FOUND", model_config_path
+            )
             
             # Check if all requirements are met
             if melody_gen_installed and vocalmix_installed and sdk_exists and checkpoint_exists and config_exists:
@@ -432,31 +1038,30 @@ def process_song(shared_dir, input_bgm, checkpoint, gen_seed, job_id=None, start
                 # Use the checkpoint path from environment variable
                 checkpoint_to_use = model_checkpoint_path
                 
+                # Create directories if they don't exist
+                _ensure_dirs(paths.melody_dir, paths.vocal_dir)
+                
                 # Generate melody using the Python package
                 melody_file = generate_melody_with_package(
                     input_bgm=input_bgm,
                     checkpoint=checkpoint_to_use,
                     gen_seed=gen_seed,
-                    output_dir=melody_output_dir,
+                    output_dir=paths.melody_dir,
                     start_time=start_time,
                     bpm=bpm
                 )
                 logger.info(f"Melody file generated successfully at: {melody_file}")
                 
-                # Check for beat_mixed_synth_mix.wav file
-                beat_mix_file = os.path.join(melody_output_dir, "beat_mixed_synth_mix.wav")
-                if os.path.exists(beat_mix_file):
-                    logger.info(f"Beat mix file found at: {beat_mix_file}")
-                else:
-                    logger.warning(f"Beat mix file not found at: {beat_mix_file}")
-                    beat_mix_file = None
+                # One directory read covers both melody outputs
+                melody_outputs = _list_dir(paths.melody_dir)
+                beat_mix_file = _find_beat_mix(paths.beat_mix, melody_outputs)
                 
                 # Mix vocals using the Python package
                 try:
                     final_mix = mix_vocals_with_package(
                         original_bgm=input_bgm,
                         melody_file=melody_file,
-                        output_dir=vocal_output_dir,
+                        output_dir=paths.vocal_dir,
                         sex=sex
                     )
                     logger.info(f"Final mix generated successfully at: {final_mix}")
@@ -469,9 +1074,10 @@ def process_song(shared_dir, input_bgm, checkpoint, gen_seed, job_id=None, start
                     final_mix = mix_vocals(
                         original_bgm=input_bgm,
                         melody_file=melody_file,
-                        output_dir=vocal_output_dir,
+                        output_dir=paths.vocal_dir,
                         container_name=vocal_container,
-                        sex=sex
+                        sex=sex,
+                        melody_checked=os.path.basename(melody_file) in melody_outputs
                     )
                     logger.info(f"Final mix generated successfully using fallback method at: {final_mix}")
                 
@@ -495,21 +1101,22 @@ def process_song(shared_dir, input_bgm, checkpoint, gen_seed, job_id=None, start
                 model_set = 'set1'
                 
                 # Update output directories to use set1
-                if job_id:
-                    melody_output_dir = os.path.join(shared_dir, "melody_results_set1", f"job_{job_id}")
-                    vocal_output_dir = os.path.join(shared_dir, "vocal_results_set1", f"job_{job_id}")
-                else:
-                    melody_output_dir = os.path.join(shared_dir, "melody_results_set1")
-                    vocal_output_dir = os.path.join(shared_dir, "vocal_results_set1")
-                
-                # Create directories if they don't exist after changing model_set
-                os.makedirs(melody_output_dir, exist_ok=True)
-                os.makedirs(vocal_output_dir, exist_ok=True)
+                paths = _make_paths(shared_dir, "set1", job_id)
         
         # If model_set is 'set1' or we've fallen back to it
         melody_container = "melody-generation-set1"
         vocal_container = "vocal-mix-set1"
         
+        # Check both containers with one probe
+        container_status = check_containers_running(melody_container, vocal_container)
+        stopped = [name for name, running in container_status.items() if not running]
+        if stopped:
+            # Fail before the melody stage rather than after it
+            raise RuntimeError(f"Required containers are not running: {', '.join(stopped)}")
+        
+        # Create directories if they don't exist
+        _ensure_dirs(paths.melody_dir, paths.vocal_dir)
+        
         logger.info(f"Processing song: {input_bgm} for job {job_id} using model set {model_set} (Docker containers)")
         logger.info(f"Parameters: start_time={start_time}, bpm={bpm}, seed={gen_seed}, sex={sex}")
         logger.info(f"Using containers: {melody_container} and {vocal_container}")
@@ -519,28 +1126,29 @@ def process_song(shared_dir, input_bgm, checkpoint, gen_seed, job_id=None, start
             input_bgm=input_bgm,
             checkpoint=checkpoint,
             gen_seed=gen_seed,
-            output_dir=melody_output_dir,
+            output_dir=paths.melody_dir,
             start_time=start_time,
             bpm=bpm,
-            container_name=melody_container
+            container_name=melody_container,
+            input_size=input_size,
+            container_running=container_status[melody_container]
         )
         logger.info(f"Melody file generated successfully at: {melody_file}")
         
-        # Check for beat_mixed_synth_mix.wav file
-        beat_mix_file = os.path.join(melody_output_dir, "beat_mixed_synth_mix.wav")
-        if os.path.exists(beat_mix_file):
-            logger.info(f"Beat mix file found at: {beat_mix_file}")
-        else:
-            logger.warning(f"Beat mix file not found at: {beat_mix_file}")
-            beat_mix_file = None
+        # One directory read covers both melody outputs; generate_melody
+        # has already confirmed melody.mid
+        beat_mix_file = _find_beat_mix(paths.beat_mix, _list_dir(paths.melody_dir))
         
         # Mix vocals using the selected container
         final_mix = mix_vocals(
             original_bgm=input_bgm,
             melody_file=melody_file,
-            output_dir=vocal_output_dir,
+            output_dir=paths.vocal_dir,
             container_name=vocal_container,
-            sex=sex
+            sex=sex,
+            container_running=container_status[vocal_container],
+            input_size=input_size,
+            melody_checked=True
         )
         logger.info(f"Final mix generated successfully at: {final_mix}")
         
@@ -1,30 +1,390 @@
 import os
 import argparse
-import gdown
-import re
+import logging
+try:
+    import re2 as re  # google-re2: linear-time matching, same compile()/search() API
+except ImportError:
+    import re
+import json
+import string
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urlsplit, parse_qs
 
+logger = logging.getLogger(__name__)
+
+# gdown pulls in tqdm, filelock and bs4; it is only imported for the
+# downloads the requests-based paths cannot handle
+_gdown = None
+
+def _get_gdown():
+    """Import gdown on first use."""
+    global _gdown
+    if _gdown is None:
+        import gdown
+        _gdown = gdown
+    return _gdown
+
+# Concurrent Range requests used for one download
+DOWNLOAD_SPLITS = 8
+# Files smaller than this are not worth splitting and are fetched in one stream
+MIN_SPLIT_SIZE = 8 * 1024 * 1024
+# Bytes read from the network per write
+CHUNK_SIZE = 1024 * 1024
+
+# One connection pool for every request, so parallel ranges and later
+# downloads reuse kept-alive TLS connections; throttling (429) and
+# transient server errors are retried with backoff, honouring Retry-After
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504)),
+))
+
+# Characters of a file ID
+_FILE_ID_CHARS = frozenset(string.ascii_letters + string.digits + '_-')
+
+def _is_file_id(s):
+    """Check for a bare file ID (25+ ASCII letters, digits, '-' or '_') in one C-level pass."""
+    return len(s) >= 25 and _FILE_ID_CHARS.issuperset(s)
+
+def _id_from_url(drive_link):
+    """Extract the file ID from a Drive or Docs URL by splitting it into its parts, or return None."""
+    try:
+        # Links may come without a scheme
+        url = urlsplit(drive_link if '//' in drive_link else '//' + drive_link)
+        host = url.hostname
+    except ValueError:
+        return None
+    # www.drive.google.com and www.docs.google.com serve the same links
+    if host and host.startswith('www.'):
+        host = host[4:]
+    segments = url.path.split('/')
+    if host == 'drive.google.com' and segments[1:3] == ['file', 'd'] and len(segments) > 3:
+        # Links like: https://drive.google.com/file/d/{FILE_ID}/view
+        file_id = segments[3]
+    elif host == 'drive.google.com' and url.path in ('/open', '/uc'):
+        # Links like: https://drive.google.com/open?id={FILE_ID}
+        # and download links like: https://drive.google.com/uc?export=download&id={FILE_ID}
+        file_id = parse_qs(url.query).get('id', [''])[0]
+    elif host == 'docs.google.com' and segments[2:3] == ['d'] and len(segments) > 3:
+        # Links like: https://docs.google.com/document/d/{FILE_ID}/edit
+        file_id = segments[3]
+    else:
+        return None
+    return file_id if file_id and _FILE_ID_CHARS.issuperset(file_id) else None
+
+@lru_cache(maxsize=4096)
 def extract_file_id(drive_link):
-    """Extract the file ID from various Google Drive link formats."""
-    # Pattern for links like: https://drive.google.com/file/d/{FILE_ID}/view
-    file_pattern = r'drive\.google\.com/file/d/([a-zA-Z0-9_-]+)'
-    
-    # Pattern for links like: https://drive.google.com/open?id={FILE_ID}
-    open_pattern = r'drive\.google\.com/open\?id=([a-zA-Z0-9_-]+)'
+    """Extract the file ID from various Google Drive link formats. Results are memoized per link."""
+    # A bare file ID needs no parsing
+    if _is_file_id(drive_link):
+        return drive_link
     
-    # Pattern for links like: https://docs.google.com/document/d/{FILE_ID}/edit
-    docs_pattern = r'docs\.google\.com/\w+/d/([a-zA-Z0-9_-]+)'
+    # The download URL gdown and this module build: .../uc?id={FILE_ID}
+    if '/uc?id=' in drive_link:
+        file_id = drive_link.partition('/uc?id=')[2].partition('&')[0]
+        if file_id and _FILE_ID_CHARS.issuperset(file_id):
+            return file_id
     
-    # Pattern for direct file IDs
-    direct_id_pattern = r'^([a-zA-Z0-9_-]{25,})(\/.*)?$'
+    if 'google.com' in drive_link:
+        return _id_from_url(drive_link)
     
-    # Try to match each pattern
-    for pattern in [file_pattern, open_pattern, docs_pattern, direct_id_pattern]:
-        match = re.search(pattern, drive_link)
-        if match:
-            return match.group(1)
+    # Direct file IDs followed by a path
+    file_id, _, _ = drive_link.partition('/')
+    if _is_file_id(file_id):
+        return file_id
     
     return None
 
+# File name in a Content-Disposition header
+_FILENAME_PATTERN = re.compile(r'filename="?([^";]+)"?')
+
+def _resolve_output(output_path, headers):
+    """
+    Resolve the output file the way gdown does: a directory (or None for the
+    current one) gets the file name from the Content-Disposition header.
+    Returns None if a name is needed and the server did not send one.
+    """
+    if output_path is None or output_path.endswith(os.sep) or os.path.isdir(output_path):
+        match = _FILENAME_PATTERN.search(headers.get("Content-Disposition", ""))
+        if not match:
+            return None
+        output_path = os.path.join(output_path or "", match.group(1))
+    return output_path
+
+def _preallocate(fd, length):
+    """
+    Size the file at fd to length bytes before the ranges are written.
+    posix_fallocate reserves the blocks up front, so concurrent writers
+    filling different parts of the file do not each grow it (and, on
+    ext4, serialize on extent updates); ftruncate is the fallback where
+    the call or the filesystem does not support it.
+    """
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, length)
+            return
+        except OSError:
+            pass
+    os.ftruncate(fd, length)
+
+def _write_at(fd, data, offset):
+    """
+    Write all of data to fd at offset, without moving the file position.
+    The written range is then dropped from the page cache: a download is
+    written once and not read back, so it should not push out other data.
+    """
+    view = memoryview(data)
+    start = offset
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+    if hasattr(os, "posix_fadvise"):
+        # Starts writeback of the range and frees its pages once clean
+        os.posix_fadvise(fd, start, offset - start, os.POSIX_FADV_DONTNEED)
+
+class ContentChangedError(IOError):
+    """The file on the server changed since a partial download was saved."""
+
+def _fetch_range(url, fd, byte_range, validator=None, cancel=None):
+    """
+    Fetch bytes byte_range[0]..byte_range[1] (inclusive) of url and write them
+    at the same offset of fd. byte_range is a list whose start is advanced as
+    bytes are written, so an interrupted fetch leaves the remaining range in it.
+    
+    Args:
+        url (str): Download URL
+        fd (int): File descriptor of the output file
+        byte_range (list): [start, end] of the bytes to fetch
+        validator (str, optional): ETag or Last-Modified of a saved partial
+            download; sent as If-Range so a changed file is not spliced in
+        cancel (threading.Event, optional): Stops the fetch when set
+    """
+    start, end = byte_range
+    headers = {"Range": f"bytes={start}-{end}"}
+    if validator:
+        headers["If-Range"] = validator
+    with _SESSION.get(url, headers=headers, stream=True, timeout=30) as response:
+        if response.status_code == 200 and validator:
+            raise ContentChangedError(f"{url} changed since the partial download was saved")
+        if response.status_code != 206:
+            raise IOError(f"Expected a partial response for bytes {start}-{end}, got HTTP {response.status_code}")
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            if cancel is not None and cancel.is_set():
+                return
+            _write_at(fd, chunk, byte_range[0])
+            byte_range[0] += len(chunk)
+    if byte_range[0] != end + 1:
+        raise IOError(f"Bytes {start}-{end} ended after {byte_range[0] - start} bytes")
+
+def _load_partial(state_path, validator, length):
+    """
+    Return the byte ranges still missing from a saved partial download, or
+    None if there is none or it belongs to another version of the file.
+    """
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or state.get("validator") != validator or state.get("length") != length:
+        return None
+    ranges = state.get("ranges")
+    if not isinstance(ranges, list) or not all(
+            isinstance(byte_range, list) and len(byte_range) == 2
+            and all(isinstance(offset, int) for offset in byte_range)
+            and 0 <= byte_range[0] <= byte_range[1] < length
+            for byte_range in ranges):
+        return None
+    return [list(byte_range) for byte_range in ranges]
+
+def _finish_partial(part_path, state_path, output_path):
+    """Move a completed .part file into place and drop its saved state."""
+    os.replace(part_path, output_path)
+    if os.path.exists(state_path):
+        os.unlink(state_path)
+
+def download_ranges(url, output_path=None, quiet=False):
+    """
+    Download a file over several concurrent HTTP Range requests, each
+    writing its own slice of the output file in place.
+    
+    The file is written to <output_path>.part. When a download is interrupted
+    and the server gave an ETag or Last-Modified, the missing ranges are saved
+    to <output_path>.part.json, and the next call for the same file fetches
+    only those, sending If-Range so a file changed in the meantime is
+    downloaded again from the start.
+    
+    Args:
+        url (str): Download URL
+        output_path (str, optional): Path to save the file. If None or a directory,
+            the name comes from the server's Content-Disposition header.
+        quiet (bool, optional): If True, prints nothing. Defaults to False.
+    
+    Returns:
+        str: Path to the downloaded file, or None if the server does not serve
+        this file in byte ranges (e.g. Drive's confirmation page for large files)
+    """
+    head = _SESSION.head(url, allow_redirects=True, timeout=30)
+    length = int(head.headers.get("Content-Length") or 0)
+    if (not head.ok or head.headers.get("Accept-Ranges") != "bytes"
+            or head.headers.get("Content-Type", "").startswith("text/html")
+            or length < MIN_SPLIT_SIZE):
+        return None
+    
+    output_path = _resolve_output(output_path, head.headers)
+    if output_path is None:
+        return None
+    
+    part_path = output_path + ".part"
+    state_path = part_path + ".json"
+    # Weak ETags cannot be used with If-Range
+    etag = head.headers.get("ETag")
+    validator = etag if etag and not etag.startswith("W/") else head.headers.get("Last-Modified")
+    
+    ranges = _load_partial(state_path, validator, length) if validator and os.path.exists(part_path) else None
+    # Only resumed ranges are conditional on the file being unchanged
+    if_range = validator if ranges is not None else None
+    if ranges is not None:
+        if not quiet:
+            logger.info("Resuming download of %s remaining bytes to: %s", sum(end - start + 1 for start, end in ranges), output_path)
+        fd = os.open(part_path, os.O_WRONLY)
+    else:
+        split_size = -(-length // DOWNLOAD_SPLITS)
+        ranges = [[start, min(start + split_size, length) - 1] for start in range(0, length, split_size)]
+        if not quiet:
+            logger.info("Downloading %s bytes in %s parts to: %s", length, len(ranges), output_path)
+        fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    
+    cancel = threading.Event()
+    try:
+        _preallocate(fd, length)
+        # A saved download may have no ranges left, only the rename
+        if ranges:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [executor.submit(_fetch_range, head.url, fd, byte_range, if_range, cancel) for byte_range in ranges]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    # Stop the other ranges so what they fetched so far can be saved
+                    cancel.set()
+                    raise
+    except ContentChangedError:
+        os.close(fd)
+        os.unlink(part_path)
+        os.unlink(state_path)
+        if not quiet:
+            logger.info("File changed on the server, downloading it again")
+        return download_ranges(url, output_path, quiet)
+    except BaseException:
+        os.close(fd)
+        remaining = [byte_range for byte_range in ranges if byte_range[0] <= byte_range[1]]
+        if not remaining:
+            # Every range arrived before the interruption; keep the file
+            _finish_partial(part_path, state_path, output_path)
+        elif validator:
+            with open(state_path, "w") as f:
+                json.dump({"validator": validator, "length": length, "ranges": remaining}, f)
+        else:
+            os.unlink(part_path)
+        raise
+    os.close(fd)
+    
+    _finish_partial(part_path, state_path, output_path)
+    return output_path
+
+def download_stream(url, output_path=None, quiet=False):
+    """
+    Download a file in one stream with requests, passing Drive's virus-scan
+    warning for large files with the confirm token from its download_warning
+    cookie.
+    
+    Args:
+        url (str): Download URL
+        output_path (str, optional): Path to save the file. If None or a directory,
+            the name comes from the server's Content-Disposition header.
+        quiet (bool, optional): If True, prints nothing. Defaults to False.
+    
+    Returns:
+        str: Path to the downloaded file, or None if Drive answered with an
+        HTML page (e.g. sign-in or a confirmation form without a cookie)
+    """
+    response = _SESSION.get(url, stream=True, timeout=30)
+    token = next((value for key, value in response.cookies.items() if key.startswith("download_warning")), None)
+    if token:
+        response.close()
+        response = _SESSION.get(url, params={"confirm": token}, stream=True, timeout=30)
+    
+    with response:
+        response.raise_for_status()
+        if response.headers.get("Content-Type", "").startswith("text/html"):
+            return None
+        output_path = _resolve_output(output_path, response.headers)
+        if output_path is None:
+            return None
+        if not quiet:
+            logger.info("Downloading to: %s", output_path)
+        
+        part_path = output_path + ".part"
+        fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            offset = 0
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                _write_at(fd, chunk, offset)
+                offset += len(chunk)
+        except BaseException:
+            os.close(fd)
+            os.unlink(part_path)
+            raise
+        os.close(fd)
+    
+    os.replace(part_path, output_path)
+    return output_path
+
+def resolve_file_id(drive_link):
+    """Return the file ID of a Google Drive link, or the link itself if it is already an ID."""
+    # Check if the link is a direct file ID or a URL
+    if '/' in drive_link and 'drive.google.com' in drive_link:
+        return extract_file_id(drive_link)
+    # Assume it's already a file ID
+    return drive_link
+
+def download_files(drive_links, output_dir=None, quiet=False, parallel=4):
+    """
+    Download several files from Google Drive concurrently.
+    
+    Each file is saved under its own name in a subdirectory of output_dir
+    named after its file ID, so files that share a name do not overwrite
+    each other; a link without a recognizable ID is saved in output_dir
+    itself. Repeated links are downloaded once.
+    
+    Args:
+        drive_links (list): Google Drive links or file IDs
+        output_dir (str, optional): Directory to save the files in. Defaults to the current directory.
+        quiet (bool, optional): If True, suppresses progress bars. Defaults to False.
+        parallel (int, optional): Number of files downloaded at the same time. Defaults to 4.
+    
+    Returns:
+        list: Path to each downloaded file, or None for each download that failed
+    """
+    def download_one(drive_link):
+        # Links with no recognizable file ID go straight into output_dir
+        file_id = extract_file_id(drive_link)
+        file_dir = os.path.join(output_dir or ".", file_id or "", "")
+        os.makedirs(file_dir, exist_ok=True)
+        return download_file(drive_link, file_dir, quiet)
+    
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        return list(executor.map(download_one, dict.fromkeys(drive_links)))
+
 def download_file(drive_link, output_path=None, quiet=False):
     """
     Download a file from Google Drive.
@@ -38,46 +398,54 @@ def download_file(drive_link, output_path=None, quiet=False):
         str: Path to the downloaded file or None if download failed
     """
     try:
-        # Check if the link is a direct file ID or a URL
-        if '/' in drive_link and 'drive.google.com' in drive_link:
-            file_id = extract_file_id(drive_link)
-            if not file_id:
-                print(f"Error: Could not extract file ID from {drive_link}")
-                return None
-        else:
-            # Assume it's already a file ID
-            file_id = drive_link
+        file_id = resolve_file_id(drive_link)
+        if not file_id:
+            logger.error("Could not extract file ID from %s", drive_link)
+            return None
         
         # Create the direct download URL
         url = f"https://drive.google.com/uc?id={file_id}"
         
-        # Download the file
-        output = gdown.download(url, output=output_path, quiet=quiet)
+        # Download the file in parallel parts when the server allows it,
+        # otherwise in one stream. gdown is only used for pages the direct
+        # download cannot get past. A failed parallel download is not
+        # retried, so running again resumes it instead
+        output = download_ranges(url, output_path, quiet)
+        if not output:
+            output = download_stream(url, output_path, quiet)
+        if not output:
+            output = _get_gdown().download(url, output=output_path, quiet=quiet)
         
         if output:
-            print(f"Successfully downloaded file to: {output}")
+            logger.info("Successfully downloaded file to: %s", output)
             return output
         else:
-            print("Download failed. The file might be too large or require authentication.")
+            logger.error("Download failed. The file might be too large or require authentication.")
             return None
             
     except Exception as e:
-        print(f"Error downloading file: {str(e)}")
+        logger.error("Error downloading file: %s", e)
         return None
 
 def main():
     parser = argparse.ArgumentParser(description="Download files from Google Drive")
-    parser.add_argument("link", help="Google Drive link or file ID")
-    parser.add_argument("-o", "--output", help="Output file path (optional)")
+    parser.add_argument("link", nargs="+", help="Google Drive link(s) or file ID(s)")
+    parser.add_argument("-o", "--output", help="Output file path, or output directory when several links are given (optional)")
     parser.add_argument("-q", "--quiet", action="store_true", help="Suppress progress bar")
+    parser.add_argument("-p", "--parallel", type=int, default=4, help="Files downloaded at the same time (default: 4)")
     
     args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(message)s")
     
-    download_file(args.link, args.output, args.quiet)
+    if len(args.link) == 1:
+        download_file(args.link[0], args.output, args.quiet)
+    else:
+        download_files(args.link, args.output, args.quiet, args.parallel)
 
 if __name__ == "__main__":
     main()
 
 # Example usage:
 # python drive_downloader.py "https://drive.google.com/file/d/1a2b3c4d5e6f7g8h9i0j/view?usp=sharing" -o "downloaded_file.pdf"
-# python drive_downloader.py "1a2b3c4d5e6f7g8h9i0j" -o "downloaded_file.pdf"
\ No newline at end of file
+# python drive_downloader.py "1a2b3c4d5e6f7g8h9i0j" -o "downloaded_file.pdf"
+# python drive_downloader.py "1a2b3c4d5e6f7g8h9i0j" "https://drive.google.com/open?id=0k9j8i7h6g5f4e3d2c1b" -o downloads -p 4
\ No newline at end of file